@@ -22,6 +22,7 @@ from num2words import num2words
 import re
 from zipfile import ZipFile
 import subprocess
+import copy
 import woocommerce
 import paramiko
 
@@ -37,7 +38,28 @@ YAML_GLOB = "*.yaml"
 YAML_EXT = "yaml"
 DB_STRUCTURE_FILE = "accounting_db_structure.sql"
 ACC_YAML = "accounting.yaml"
+SNAPSHOT_SUBDIR = ".snapshot"
+CLIENT_INDEX_FILE = "client_index.json"
 INVOICE_TYPES = ["Hourly", "Monthly", "Storage"]
+# Sync actions needed for each kind of config change
+CONFIG_CHANGE_ACTIONS = {
+    "client_added": ["asset-labels", "wiki", "template", "envelopes"],
+    "client_removed": [],
+    "client_changed": ["wiki", "template"],
+    "envelope_changed": ["envelopes"],
+    "asset_added": ["asset-labels", "wiki", "template"],
+    "asset_removed": ["wiki", "template"],
+    "asset_changed": ["asset-labels", "wiki", "template"],
+    "tariff_changed": ["asset-labels", "wiki", "template"],
+    "ssh_changed": ["wiki", "template"]
+}
+# Commands of sync actions in the order they are run, --include-clients is added with affected clients
+CONFIG_SYNC_COMMANDS = {
+    "asset-labels": ["accounting.py", "--asset-labels"],
+    "wiki": ["projects.py", "--git-commit", "--git-push", "--update-admin-project-wiki-for-all-clients"],
+    "template": ["projects.py", "--git-commit", "--git-push", "--template-salt-project-for-all-clients"],
+    "envelopes": ["accounting.py", "--update-envelopes-for-all-clients"]
+}
 
 # Functions
 
@@ -214,13 +236,20 @@ if __name__ == "__main__":
     parser.add_argument("--dry-run-woocommerce", dest="dry_run_woocommerce", help="no woocommerce api commands executed", action="store_true")
     parser.add_argument("--timelogs-spent-before-date", dest="timelogs_spent_before_date", help="select unchecked timelogs for hourly invoices spent before date DATE", nargs=1, metavar=("DATE"))
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--parse-workers", dest="parse_workers", help="parse client yamls in N parallel processes if there is no actual config snapshot, also used by --yaml-check", nargs=1, metavar=("N"))
+    parser.add_argument("--since", dest="since", help="run --yaml-check only for clients depending on files changed against git ref REF, all clients are checked if git fails", nargs=1, metavar=("REF"))
+    parser.add_argument("--json-output", dest="json_output", help="print --yaml-check report as JSON", action="store_true")
+    parser.add_argument("--affected-since-snapshot", dest="affected_since_snapshot", help="run --yaml-check, --asset-labels only for clients affected by config changes since config snapshot HASH", nargs=1, metavar=("HASH"))
     group = parser.add_mutually_exclusive_group(required=False)
     group.add_argument("--exclude-clients", dest="exclude_clients", help="exclude clients defined by JSON_LIST from all-clients operations", nargs=1, metavar=("JSON_LIST"))
     group.add_argument("--include-clients", dest="include_clients", help="include only clients defined by JSON_LIST for all-clients operations", nargs=1, metavar=("JSON_LIST"))
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--db-structure", dest="db_structure", help="create database structure", action="store_true")
     group.add_argument("--yaml-check", dest="yaml_check", help="check yaml structure", action="store_true")
-    group.add_argument("--asset-labels", dest="asset_labels", help="sync asset labels", action="store_true")
+    group.add_argument("--build-config-snapshot", dest="build_config_snapshot", help="build compiled config snapshot of accounting, client and tariff yamls if changed and print its hash", action="store_true")
+    group.add_argument("--asset-labels", dest="asset_labels", help="sync asset labels excluding --exclude-clients or only for --include-clients", action="store_true")
+    group.add_argument("--config-changes", dest="config_changes", help="print changes of resolved config since last applied config saved in database and sync actions needed as JSON", action="store_true")
+    group.add_argument("--apply-config-changes", dest="apply_config_changes", help="run only sync actions needed for changes of resolved config since last applied config for affected clients, save config as applied", action="store_true")
     group.add_argument("--issues-check", dest="issues_check", help="report issue activities as new issue in accounting project", action="store_true")
     group.add_argument("--merge-requests-check", dest="merge_requests_check", help="report MR activities as new issue in accounting project", action="store_true")
     group.add_argument("--storage-usage", dest="storage_usage", help="save all clients billable storage usage to database, excluding --exclude-clients or only for --include-clients", action="store_true")
@@ -255,7 +284,7 @@ if __name__ == "__main__":
         logger = set_logger(logging.ERROR, LOG_DIR, LOG_FILE)
 
     # Skip vars check where not needed
-    if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+    if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
 
         PG_DB_HOST = os.environ.get("PG_DB_HOST")
         if PG_DB_HOST is None:
@@ -273,7 +302,7 @@ if __name__ == "__main__":
         if PG_DB_PASS is None:
             raise Exception("Env var PG_DB_PASS missing")
 
-    if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients or args.db_structure):
+    if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients or args.db_structure):
 
         GL_ADMIN_PRIVATE_TOKEN = os.environ.get("GL_ADMIN_PRIVATE_TOKEN")
         if GL_ADMIN_PRIVATE_TOKEN is None:
@@ -321,16 +350,63 @@ if __name__ == "__main__":
         os.chdir(WORK_DIR)
 
         # Skip pgconnect where not needed
-        if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+        if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
 
             # Connect to PG
             dsn = "host={} dbname={} user={} password={}".format(PG_DB_HOST, PG_DB_NAME, PG_DB_USER, PG_DB_PASS)
             conn = psycopg2.connect(dsn)
 
-        # Read ACC_YAML
-        acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
-        if acc_yaml_dict is None:
-            raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+        # Parse client files in parallel if requested
+        parse_workers = int(args.parse_workers[0]) if args.parse_workers is not None else None
+
+        # Client of single client commands, None for all clients
+        single_client_name = None
+        for client_args in [args.update_envelopes_for_client, args.list_assets_for_client]:
+            if client_args is not None:
+                single_client_name = client_args[0]
+
+        # Registry to fall back to if snapshot cannot be built
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, index_file="{0}/{1}/{2}".format(WORK_DIR, SNAPSHOT_SUBDIR, CLIENT_INDEX_FILE))
+
+        # Load compiled config snapshot, it is rebuilt if any of config files changed
+        # YAML check should always parse source files
+        # Single client commands parse only the needed client using client index instead
+        if args.yaml_check or single_client_name is not None:
+            config_snapshot = None
+        else:
+            config_snapshot = load_config_snapshot(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, SNAPSHOT_SUBDIR, logger, parse_workers, client_registry)
+
+        if config_snapshot is not None:
+
+            acc_yaml_dict = config_snapshot["acc_yaml"]
+
+            # Client files are already loaded in snapshot
+            client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, config_snapshot["clients"], config_snapshot["deps"])
+
+        else:
+
+            # Read ACC_YAML
+            acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+            if acc_yaml_dict is None:
+                raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+
+            # Client files are loaded once per run, clients parsed by failed snapshot build are reused
+            # YAML check parses clients in its own workers only, dependencies for --since are taken from client index
+            if parse_workers is not None and not args.yaml_check:
+                client_registry.preload(parse_workers)
+
+        # Select only clients affected by config changes since snapshot
+        if args.affected_since_snapshot is not None:
+            client_registry.select(affected_client_files(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, TARIFFS_SUBDIR, SNAPSHOT_SUBDIR, args.affected_since_snapshot[0], client_registry, logger))
+
+        # Select only clients affected by changes against git ref
+        if args.since is not None:
+            since_client_files = affected_client_files_since_ref(WORK_DIR, ACC_YAML, args.since[0], client_registry, logger)
+            if since_client_files is not None:
+                client_registry.select(since_client_files)
+
+        # Tariffs are taken at the same date time for the whole run
+        at_datetime = datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()
         
         # Do tasks
 
@@ -369,14 +445,12 @@ if __name__ == "__main__":
             errors = False
 
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.client_files:
                 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
 
                 # Check if client is active
                 if client_dict["active"] and (
@@ -399,7 +473,7 @@ if __name__ == "__main__":
                                                     )
                                                 ):
 
-                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                    asset_list = client_registry.asset_list(client_dict, at_datetime)
 
                     # If there are assets
                     if len(asset_list) > 0:
@@ -505,14 +579,12 @@ if __name__ == "__main__":
                 raise Exception("Caught exception on gsuite execution")
 
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.client_files_for(single_client_name):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
                 
                 # Check specific client
                 if args.update_envelopes_for_client is not None:
@@ -630,14 +702,12 @@ if __name__ == "__main__":
             uploaded_pdfs = []
 
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.client_files:
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
                 
                 # Check specific client
                 if args.make_pdfs_for_client is not None:
@@ -776,14 +846,12 @@ if __name__ == "__main__":
             if args.make_gmail_drafts_for_all_clients or args.print_papers_for_all_clients:
 
                 # For *.yaml in client dir
-                for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+                for client_file in client_registry.client_files:
 
                     logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    client_dict = client_registry.load(client_file)
 
                     # Check client active and exclude/include
                     if client_dict["active"] and (
@@ -818,9 +886,7 @@ if __name__ == "__main__":
                 else:
                     raise Exception("Impossible became possible")
 
-                client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_in_arg.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.get(client_in_arg)
 
                 clients_dict[client_dict["name"]] = client_dict
 
@@ -1187,106 +1253,132 @@ if __name__ == "__main__":
                         else:
                             logger.info("No unprinted invoices for client {0} found".format(client))
 
-        if args.yaml_check:
+        if args.build_config_snapshot:
 
-            # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            if config_snapshot is None:
+                raise Exception("Config snapshot build failed, run with --yaml-check to see errors")
 
-                logger.info("Found client file: {0}".format(client_file))
+            print(config_snapshot["hash"])
 
-                try:
+        if args.config_changes or args.apply_config_changes:
 
-                    # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+            # Sync commands change GitLab and git repos on their own, so dry run cannot be applied partially, use --config-changes to preview
+            if args.apply_config_changes and (args.dry_run_gitlab or args.dry_run_db):
+                raise Exception("--apply-config-changes cannot be used with --dry-run-gitlab or --dry-run-db, use --config-changes to see changes")
 
-                    # Basic checks
+            # New cursor
+            cur = conn.cursor()
 
-                    if "name" not in client_dict:
-                        raise Exception("name key missing in: {0}/{1}".format(WORK_DIR, client_file))
+            # Get last applied config state
+            sql = """
+            SELECT
+                    config_state
+            FROM
+                    config_applied
+            ORDER BY
+                    id DESC
+            LIMIT 1
+            ;
+            """
+            logger.info("Query:")
+            logger.info(sql)
+            try:
+                cur.execute(sql)
+                logger.info("Query execution status:")
+                logger.info(cur.statusmessage)
+                applied_row = cur.fetchone()
+            except Exception as e:
+                raise Exception("Caught exception on query execution")
 
-                    if "billing" not in client_dict:
-                        raise Exception("billing key missing in: {0}/{1}".format(WORK_DIR, client_file))
+            # Without applied config all clients are new
+            applied_config_state = applied_row[0] if applied_row is not None else {}
+            current_config_state = config_state(client_registry, at_datetime)
+            changes = config_changes(applied_config_state, current_config_state)
 
-                    if "code" not in client_dict["billing"]:
-                        raise Exception("billing:code key missing in: {0}/{1}".format(WORK_DIR, client_file))
+            # Collect affected clients per sync action
+            sync_actions = {}
+            for change in changes:
+                for sync_action in CONFIG_CHANGE_ACTIONS[change["change"]]:
+                    sync_actions.setdefault(sync_action, [])
+                    if change["client"] not in sync_actions[sync_action]:
+                        sync_actions[sync_action].append(change["client"])
 
-                    if "active" not in client_dict:
-                        raise Exception("active key missing in: {0}/{1}".format(WORK_DIR, client_file))
-                    
-                    if "start_date" not in client_dict:
-                        raise Exception("start_date key missing in: {0}/{1}".format(WORK_DIR, client_file))
+            print(json.dumps({"changes": changes, "actions": sync_actions}, indent=4))
 
-                    # Check these only for active clients
-                    if client_dict["active"]:
+            if args.apply_config_changes:
 
-                        if "gsuite" not in client_dict:
-                            raise Exception("gsuite key missing in: {0}/{1}".format(WORK_DIR, client_file))
-                        if "folder" not in client_dict["gsuite"]:
-                            raise Exception("gsuite:folder key missing in: {0}/{1}".format(WORK_DIR, client_file))
+                # Run sync actions in fixed order, any failure stops applying and config is not saved as applied
+                for sync_action, sync_command in CONFIG_SYNC_COMMANDS.items():
 
-                        if "gitlab" not in client_dict:
-                            raise Exception("gitlab key missing in: {0}/{1}".format(WORK_DIR, client_file))
-                        if "admin_project" not in client_dict["gitlab"]:
-                            raise Exception("gitlab:admin_project key missing in: {0}/{1}".format(WORK_DIR, client_file))
-                        if "path" not in client_dict["gitlab"]["admin_project"]:
-                            raise Exception("gitlab:admin_project:path key missing in: {0}/{1}".format(WORK_DIR, client_file))
+                    if sync_action not in sync_actions:
+                        continue
 
-                        asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                    script = [os.path.join(currentdir, sync_command[0])] + (["--debug"] if args.debug else []) + sync_command[1:] + ["--include-clients", json.dumps(sync_actions[sync_action])]
+                    logger.info("Running sync action {0}: {1}".format(sync_action, script))
+                    subprocess.run(script, check=True)
 
-                        # For each asset
-                        for asset in asset_list:
+                # Save config as applied
+                sql = """
+                INSERT INTO
+                        config_applied
+                        (
+                                config_hash
+                        ,       config_state
+                        )
+                VALUES
+                        (
+                                %s
+                        ,       %s
+                        )
+                ;
+                """
+                logger.info("Query:")
+                logger.info(sql)
+                try:
+                    cur.execute(sql, (json_hash(current_config_state), json.dumps(current_config_state)))
+                    logger.info("Query execution status:")
+                    logger.info(cur.statusmessage)
+                except Exception as e:
+                    raise Exception("Caught exception on query execution")
 
-                            try:
+                if not args.dry_run_db:
+                    conn.commit()
 
-                                logger.info("Asset: {0}".format(asset["fqdn"]))
+            # Close cursor
+            cur.close()
 
-                                if "fqdn" not in asset:
-                                    raise Exception("fqdn key missing in asset {asset}".format(asset=asset))
+        if args.yaml_check:
 
-                                if "active" not in asset:
-                                    raise Exception("active key missing in asset {asset}".format(asset=asset["fqdn"]))
+            yaml_check_errors = []
 
-                                # Check only active assets
-                                if asset["active"]:
+            # Global jobs are checked by the same job schema as client and asset jobs
+            for acc_yaml_error in validate_acc_yaml_jobs(acc_yaml_dict):
+                acc_yaml_error["file"] = ACC_YAML
+                yaml_check_errors.append(acc_yaml_error)
 
-                                    # location and os key is needed only with pipelines
-                                    if (
-                                            "salt_project" in client_dict["gitlab"]
-                                            and
-                                            (("jobs_disabled" in client_dict and not client_dict["jobs_disabled"]) or "jobs_disabled" not in client_dict)
-                                            and
-                                            (("jobs_disabled" in asset and not asset["jobs_disabled"]) or "jobs_disabled" not in asset)
-                                        ):
-                                        
-                                        if "location" not in asset:
-                                            raise Exception("location keys missing in asset {asset}".format(asset=asset["fqdn"]))
-                                    
-                                        if "os" not in asset:
-                                            raise Exception("os key missing in asset {asset}".format(asset=asset["fqdn"]))
-                                        
-                                        if asset["os"] not in acc_yaml_dict["os"]:
-                                            raise Exception("os value {os} not in globally allowed list for asset {asset}".format(os=asset["os"], asset=asset["fqdn"]))
+            # Check clients in parallel if requested, errors of all clients are collected
+            worker_args_list = [(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, acc_yaml_dict["os"], at_datetime, logger) for client_file in client_registry.client_files_for(single_client_name)]
+            if parse_workers is not None:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers) as executor:
+                    yaml_check_results = list(executor.map(yaml_check_client_worker, worker_args_list))
+            else:
+                yaml_check_results = [yaml_check_client_worker(worker_args) for worker_args in worker_args_list]
 
-                                    for asset_t in asset["tariffs"]:
-                                        for asset_tariff in asset_t["tariffs"]:
+            # Errors of tariff files referenced by many clients are reported once
+            for client_file, client_errors in yaml_check_results:
+                logger.info("Checked client file: {0}".format(client_file))
+                for client_error in client_errors:
+                    if client_error not in yaml_check_errors:
+                        yaml_check_errors.append(client_error)
 
-                                            # If tariff has file key - load it
-                                            if "file" in asset_tariff:
-                                                
-                                                tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                                                if tariff_dict is None:
-                                                    
-                                                    raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+            for yaml_check_error in yaml_check_errors:
+                logger.error("{file}{asset}{path}: {error}".format(file=yaml_check_error["file"], asset=" asset " + yaml_check_error["asset"] if yaml_check_error["asset"] is not None else "", path=" " + yaml_check_error["path"] if yaml_check_error["path"] else "", error=yaml_check_error["error"]))
 
-                            except:
-                                logger.error("Asset {asset} yaml check exception".format(asset=asset["fqdn"]))
-                                raise
+            if args.json_output:
+                print(json.dumps({"checked_files": len(yaml_check_results), "errors": yaml_check_errors}, indent=4))
 
-                except:
-                    logger.error("Client {client} yaml check exception".format(client=client_dict["name"]))
-                    raise
+            if len(yaml_check_errors) > 0:
+                raise Exception("YAML check found {0} errors".format(len(yaml_check_errors)))
 
         if args.asset_labels:
             
@@ -1295,17 +1387,33 @@ if __name__ == "__main__":
             gl.auth()
         
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.client_files_for(single_client_name):
                 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
 
-                # Check if client is active
-                if client_dict["active"]:
+                # Check if client is active and not excluded
+                if client_dict["active"] and (
+                                                (
+                                                    args.exclude_clients is not None
+                                                    and
+                                                    client_dict["name"].lower() not in exclude_clients_list
+                                                )
+                                                or
+                                                (
+                                                    args.include_clients is not None
+                                                    and
+                                                    client_dict["name"].lower() in include_clients_list
+                                                )
+                                                or
+                                                (
+                                                    args.exclude_clients is None
+                                                    and
+                                                    args.include_clients is None
+                                                )
+                                            ):
 
                     # Make project list (we need to add asset labels to admin_project AND other projects of client from accounting yaml with asset_labels = True)
                     project_list = []
@@ -1323,8 +1431,9 @@ if __name__ == "__main__":
                         # Get GitLab project for client
                         project = gl.projects.get(project_from_list)
                         labels = project.labels.list(all=True)
+                        labels_by_name = {label.name: label for label in labels}
 
-                        asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), False)
+                        asset_list = client_registry.asset_list(client_dict, at_datetime, False)
 
                         # Iterate over assets in client
                         for asset in asset_list:
@@ -1345,7 +1454,7 @@ if __name__ == "__main__":
                                 # If tariff has file key - load it
                                 if "file" in asset_tariff:
                                     
-                                    tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
+                                    tariff_dict = load_tariff(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
                                     if tariff_dict is None:
                                         
                                         raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
@@ -1364,17 +1473,16 @@ if __name__ == "__main__":
                             logger.info("Asset Label description: {0}".format(asset_label_description))
 
                             # Check if label with the same description exists
-                            if any(label.name == asset["fqdn"] and label.description == asset_label_description and label.color == asset_color for label in labels):
+                            label = labels_by_name.get(asset["fqdn"])
+                            if label is not None and label.description == asset_label_description and label.color == asset_color:
                                 logger.info("Existing label found: {0}, {1}, {2}".format(asset["fqdn"], asset_label_description, asset_color))
                             # Else if exists with not the same
-                            elif any(label.name == asset["fqdn"] for label in labels):
-                                for label in labels:
-                                    if label.name == asset["fqdn"]:
-                                        label.description = asset_label_description
-                                        label.color = asset_color
-                                        logger.info("Existing label found but description or color didn't match, updated: {0}, {1}, {2}".format(asset["fqdn"], asset_label_description, asset_color))
-                                        if not args.dry_run_gitlab:
-                                            label.save()
+                            elif label is not None:
+                                label.description = asset_label_description
+                                label.color = asset_color
+                                logger.info("Existing label found but description or color didn't match, updated: {0}, {1}, {2}".format(asset["fqdn"], asset_label_description, asset_color))
+                                if not args.dry_run_gitlab:
+                                    label.save()
                             # Add if not exists
                             else:
                                 logger.info("No existing label found, added: {0}, {1}, {2}".format(asset["fqdn"], asset_label_description, asset_color))
@@ -1385,14 +1493,12 @@ if __name__ == "__main__":
 
             # For *.yaml in client dir
             clients_dict = {}
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.client_files:
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
 
                 if "hourly_only" in client_dict["billing"]:
                     clients_dict[client_dict["name"].lower()] = {"hourly_only": client_dict["billing"]["hourly_only"]}
@@ -2070,14 +2176,12 @@ if __name__ == "__main__":
 
             # For *.yaml in client dir
             clients_dict = {}
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.client_files:
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
 
                 if "hourly_only" in client_dict["billing"]:
                     clients_dict[client_dict["name"].lower()] = {"hourly_only": client_dict["billing"]["hourly_only"]}
@@ -3536,9 +3640,7 @@ if __name__ == "__main__":
                     client_name = timelogs_check_client.lower()
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_name, YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client_name, YAML_EXT))
+                    client_dict = client_registry.get(client_name)
 
                     # Find project ids for needed projects
 
@@ -4129,30 +4231,18 @@ if __name__ == "__main__":
                                 client_name = acc_yaml_dict["projects"][row_project_path_with_namespace]["client"].lower()
 
                                 # Load client YAML
-                                client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_name, YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                                if client_dict is None:
-                                    raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client_name, YAML_EXT))
-
-                                # Check if other label name is asset
-                                else:
+                                client_dict = client_registry.get(client_name)
 
-                                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), False)
+                                # Check if other label name is asset of the client
+                                indexed_asset = client_registry.find_asset(row_imr_labels_split_label)
+                                if indexed_asset is not None and indexed_asset.client_dict is client_dict:
 
-                                    # If there are assets
-                                    if len(asset_list) > 0:
-
-                                        # Iterate over assets in client
-                                        for client_asset in asset_list:
-
-                                            # Check if asset name matches label
-                                            if client_asset["fqdn"] == row_imr_labels_split_label:
-
-                                                # Find checked tariff
-                                                try:
-                                                    checked_tariffs = activated_tariff(client_asset["tariffs"], row_timelog_updated, logger)["tariffs"]
-                                                except:
-                                                    logger.error("Asset {asset} imr {gitlab}/{imr} find active tariff error".format(asset=client_asset["fqdn"], gitlab=acc_yaml_dict["gitlab"]["url"], imr=row_imr_link))
-                                                    raise
+                                    # Find checked tariff
+                                    try:
+                                        checked_tariffs = indexed_asset.timeline.lookup(row_timelog_updated)[0]["tariffs"]
+                                    except:
+                                        logger.error("Asset {asset} imr {gitlab}/{imr} find active tariff error".format(asset=indexed_asset.asset["fqdn"], gitlab=acc_yaml_dict["gitlab"]["url"], imr=row_imr_link))
+                                        raise
 
                                 # Check if we have some tariff to check
                                 # It is ok if None - it means the label is not asset label (not monetazible)
@@ -4168,7 +4258,7 @@ if __name__ == "__main__":
                                         # If tariff has file key - load it
                                         if "file" in checked_tariff:
                                             
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, checked_tariff["file"]), logger)
+                                            tariff_dict = load_tariff(WORK_DIR, TARIFFS_SUBDIR, checked_tariff["file"], logger)
                                             if tariff_dict is None:
                                                 
                                                 raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, checked_tariff["file"]))
@@ -4322,14 +4412,12 @@ if __name__ == "__main__":
 
                     # For *.yaml in client dir
 
-                    for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+                    for client_file in client_registry.client_files:
 
                         logger.info("Found client file: {0}".format(client_file))
 
                         # Load client YAML
-                        client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                        if client_dict is None:
-                            raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                        client_dict = client_registry.load(client_file)
 
                         # Add only active clients and not excluded
                         if client_dict["active"] and not ("monthly_invoice_disabled" in client_dict["billing"] and client_dict["billing"]["monthly_invoice_disabled"]) and (
@@ -4359,9 +4447,7 @@ if __name__ == "__main__":
 
                     client_in_arg, month_in_arg = args.make_monthly_invoice_for_client
 
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_in_arg.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    client_dict = client_registry.get(client_in_arg)
 
                     clients_dict[client_dict["name"].lower()] = client_dict
 
@@ -4387,13 +4473,16 @@ if __name__ == "__main__":
                         
                         client_asset_tariffs_dict[client] = {}
 
-                        asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                        asset_list = client_registry.asset_list(client_dict, at_datetime)
 
                         # If there are assets
                         if len(asset_list) > 0:
 
+                            # Find checked tariffs of all assets at once
+                            asset_tariffs_entries = TariffBatchResolver([asset["tariffs"] for asset in asset_list]).entries(range(len(asset_list)), [needed_month_for_tariff] * len(asset_list))
+
                             # Iterate over assets in client
-                            for asset in asset_list:
+                            for asset, asset_tariffs_entry in zip(asset_list, asset_tariffs_entries):
 
                                 # Only active assets
 
@@ -4403,20 +4492,22 @@ if __name__ == "__main__":
 
                                     client_asset_tariffs_dict[client][asset["fqdn"]] = []
 
-                                    # Find checked tariff
-                                    for asset_tariff in activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["tariffs"]:
+                                    # Checked tariff dates
+                                    asset_tariffs_activated = asset_tariffs_entry["activated"]
+                                    asset_tariffs_added = asset_tariffs_entry.get("added")
+                                    for asset_tariff in asset_tariffs_entry["tariffs"]:
 
                                         # If tariff has file key - load it
                                         if "file" in asset_tariff:
                                             
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
+                                            tariff_dict = load_tariff(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
                                             if tariff_dict is None:
                                                 
                                                 raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
 
                                             # Add tariff activation date per asset
-                                            tariff_dict["activated_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["activated"].strftime("%Y-%m-%d"))
-                                            tariff_dict["added_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["added"].strftime("%Y-%m-%d"))
+                                            tariff_dict["activated_date"] = str(asset_tariffs_activated.strftime("%Y-%m-%d"))
+                                            tariff_dict["added_date"] = str(asset_tariffs_added.strftime("%Y-%m-%d"))
                                         
                                             # Add migrated key
                                             if "migrated_from" in asset_tariff:
@@ -4434,9 +4525,12 @@ if __name__ == "__main__":
                                         # Also take inline plan and service
                                         else:
 
+                                            # Inline tariff belongs to client dict shared by the whole run, annotate its copy
+                                            asset_tariff = copy.deepcopy(asset_tariff)
+
                                             # Add tariff activation date per asset
-                                            asset_tariff["activated_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["activated"].strftime("%Y-%m-%d"))
-                                            asset_tariff["added_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["added"].strftime("%Y-%m-%d"))
+                                            asset_tariff["activated_date"] = str(asset_tariffs_activated.strftime("%Y-%m-%d"))
+                                            asset_tariff["added_date"] = str(asset_tariffs_added.strftime("%Y-%m-%d"))
                                             
                                             # Add migrated key
                                             if "migrated_from" in asset_tariff:
@@ -4491,9 +4585,7 @@ if __name__ == "__main__":
                     # Check invoice shift from client yaml if exist, if not = 0
                     
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client, YAML_EXT))
+                    client_dict = client_registry.get(client)
 
                     if "month_shift" in client_dict["billing"]["papers"]:
                         month_delta = int(month_in_arg) + int(client_dict["billing"]["papers"]["month_shift"])
@@ -4687,14 +4779,12 @@ if __name__ == "__main__":
                 storage_details = {}
 
                 # For *.yaml in client dir
-                for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+                for client_file in client_registry.client_files:
                     
                     logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    client_dict = client_registry.load(client_file)
 
                     # Check if specific client and client is active
                     if ((needed_client is not None and client_dict["name"].lower() == needed_client) or needed_client is None) and client_dict["active"] and (
@@ -4717,11 +4807,15 @@ if __name__ == "__main__":
                                                                                                                                                                 )
                                                                                                                                                             ):
 
-                        asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                        asset_list = client_registry.asset_list(client_dict, at_datetime)
 
                         # If there are assets
                         if len(asset_list) > 0:
 
+                            # Find tariffs of active assets with storage at once, they are taken in asset list order
+                            storage_asset_list = [asset for asset in asset_list if asset["active"] and "storage" in asset]
+                            asset_tariffs_entries = iter(TariffBatchResolver([asset["tariffs"] for asset in storage_asset_list]).entries(range(len(storage_asset_list)), [needed_month_for_tariff] * len(storage_asset_list)))
+
                             # Iterate over assets in client
                             for asset in asset_list:
 
@@ -4733,12 +4827,12 @@ if __name__ == "__main__":
 
                                     storage_tariff_found = False
                                     
-                                    for tariff in activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["tariffs"]:
+                                    for tariff in next(asset_tariffs_entries)["tariffs"]:
 
                                         # If tariff has file key - load it
                                         if "file" in tariff:
                                             
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, tariff["file"]), logger)
+                                            tariff_dict = load_tariff(WORK_DIR, TARIFFS_SUBDIR, tariff["file"], logger)
                                             if tariff_dict is None:
                                                 
                                                 raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, tariff["file"]))
@@ -4868,9 +4962,7 @@ if __name__ == "__main__":
                 logger.info(json.dumps(invoice_details[client], indent=2))
                         
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client, YAML_EXT))
+                client_dict = client_registry.get(client)
 
                 # Check if papers needed or not
                 if client_dict["billing"]["papers"]["invoice"]["print"] or client_dict["billing"]["papers"]["act"]["print"]:
@@ -5548,14 +5640,12 @@ if __name__ == "__main__":
         if args.list_assets_for_client is not None or args.list_assets_for_all_clients:
             
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.client_files_for(single_client_name):
                 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
                 
                 # Check specific client
                 if args.list_assets_for_client is not None:
@@ -5566,7 +5656,7 @@ if __name__ == "__main__":
                 # Check if client is active
                 if client_dict["active"]:
 
-                    asset_list = sorted(get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()), key = lambda x: (x["tariffs"][-1]["activated"]))
+                    asset_list = sorted(client_registry.asset_list(client_dict, at_datetime), key = lambda x: (x["tariffs"][-1]["activated"]))
 
                     # Iterate over assets
                     for asset in asset_list:
@@ -5612,7 +5702,7 @@ if __name__ == "__main__":
                         ))
 
         # Skip connection close where not needed
-        if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+        if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
             # Close connection
             conn.close()
 
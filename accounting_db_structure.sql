@@ -118,9 +118,50 @@ CREATE TABLE IF NOT EXISTS jobs_log (
 	job_tz TEXT NOT NULL
 );
 
+ALTER TABLE jobs_log ADD COLUMN IF NOT EXISTS job_triggered BOOLEAN NOT NULL DEFAULT TRUE;
+
 CREATE INDEX IF NOT EXISTS jobs_log_created_at ON jobs_log (created_at);
 CREATE INDEX IF NOT EXISTS jobs_log_jobs_script_run_at ON jobs_log (jobs_script_run_at);
 CREATE INDEX IF NOT EXISTS jobs_log_asset_fqdn ON jobs_log (asset_fqdn);
 CREATE INDEX IF NOT EXISTS jobs_log_client ON jobs_log (client);
 CREATE INDEX IF NOT EXISTS jobs_log_job_id ON jobs_log (job_id);
 CREATE INDEX IF NOT EXISTS jobs_log_asset_fqdn_client_job_id_combo ON jobs_log (asset_fqdn, client, job_id);
+
+
+CREATE TABLE IF NOT EXISTS jobs_last_run (
+	client TEXT NOT NULL,
+	asset_fqdn TEXT NOT NULL,
+	job_id TEXT NOT NULL,
+	jobs_log_id INTEGER NOT NULL,
+	jobs_script_run_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	job_tz TEXT NOT NULL,
+	PRIMARY KEY (client, asset_fqdn, job_id)
+);
+
+INSERT INTO jobs_last_run (client, asset_fqdn, job_id, jobs_log_id, jobs_script_run_at, job_tz)
+	SELECT DISTINCT ON (client, asset_fqdn, job_id) client, asset_fqdn, job_id, id, jobs_script_run_at, job_tz
+	FROM jobs_log
+	WHERE job_triggered AND NOT EXISTS (SELECT 1 FROM jobs_last_run)
+	ORDER BY client, asset_fqdn, job_id, id DESC;
+
+
+CREATE TABLE IF NOT EXISTS jobs_next_due (
+	client TEXT NOT NULL,
+	asset_fqdn TEXT NOT NULL,
+	job_id TEXT NOT NULL,
+	schedule_hash TEXT NOT NULL,
+	next_due_at TIMESTAMP WITHOUT TIME ZONE,
+	PRIMARY KEY (client, asset_fqdn, job_id)
+);
+
+CREATE INDEX IF NOT EXISTS jobs_next_due_next_due_at ON jobs_next_due (next_due_at);
+
+
+CREATE TABLE IF NOT EXISTS config_applied (
+	id SERIAL PRIMARY KEY,
+	applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+	config_hash TEXT NOT NULL,
+	config_state JSONB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS config_applied_applied_at ON config_applied (applied_at);
@@ -11,7 +11,8 @@ import pytz
 from datetime import datetime
 from datetime import time
 import psycopg2
-import base64
+import psycopg2.extras
+from time import monotonic
 
 # Constants and envs
 
@@ -24,6 +25,8 @@ CLIENTS_SUBDIR = "clients"
 YAML_GLOB = "*.yaml"
 YAML_EXT = "yaml"
 ACC_YAML = "accounting.yaml"
+SNAPSHOT_SUBDIR = ".snapshot"
+CLIENT_INDEX_FILE = "client_index.json"
 LOCK_TIMEOUT = 600 # Supposed to be run each 10 minutes, so lock for 10 minutes
 MINUTES_JITTER = 10 # Jobs are run on some minute between 00 and 10 minutes each 10 minutes
 
@@ -41,6 +44,8 @@ if __name__ == "__main__":
                           action="store_true")
     parser.add_argument("--dry-run-pipeline", dest="dry_run_pipeline", help="do not execute pipeline script", action="store_true")
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--parse-workers", dest="parse_workers", help="parse client yamls in N parallel processes if there is no actual config snapshot", nargs=1, metavar=("N"))
+    parser.add_argument("--trigger-workers", dest="trigger_workers", help="trigger pipelines of due jobs in N parallel threads after all jobs are evaluated, jobs of one salt project are triggered in order", nargs=1, metavar=("N"))
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--run-job", dest="run_job", help="run specific job id JOB for asset ASSET (use ALL for all assets) via GitLab pipelines for CLIENT (use ALL for all clients)", nargs=3, metavar=("CLIENT", "ASSET", "JOB"))
@@ -76,15 +81,58 @@ if __name__ == "__main__":
         # Chdir to work dir
         os.chdir(WORK_DIR)
 
-        # Read ACC_YAML
-        acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
-        if acc_yaml_dict is None:
-            raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+        # Parse client files in parallel if requested
+        parse_workers = int(args.parse_workers[0]) if args.parse_workers is not None else None
+
+        # Trigger pipelines in parallel if requested
+        trigger_workers = int(args.trigger_workers[0]) if args.trigger_workers is not None else None
+
+        # Client of single client commands, None for all clients
+        single_client_name = None
+        for client_args in [args.run_jobs, args.run_job, args.force_run_job, args.prune_run_tags]:
+            if client_args is not None and client_args[0] != "ALL":
+                single_client_name = client_args[0]
+
+        # Registry to fall back to if snapshot cannot be built
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, index_file="{0}/{1}/{2}".format(WORK_DIR, SNAPSHOT_SUBDIR, CLIENT_INDEX_FILE))
+
+        # Load compiled config snapshot, it is rebuilt if any of config files changed
+        # Single client commands parse only the needed client using client index instead
+        if single_client_name is None:
+            config_snapshot = load_config_snapshot(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, SNAPSHOT_SUBDIR, logger, parse_workers, client_registry)
+        else:
+            config_snapshot = None
+
+        if config_snapshot is not None:
+
+            acc_yaml_dict = config_snapshot["acc_yaml"]
+
+            # Client files are already loaded in snapshot
+            client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, config_snapshot["clients"], config_snapshot["deps"])
+
+        else:
+
+            # Read ACC_YAML
+            acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+            if acc_yaml_dict is None:
+                raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+
+            # Client files are loaded once per run, clients parsed by failed snapshot build are reused
+            if parse_workers is not None:
+                client_registry.preload(parse_workers)
+
+        # Tariffs are taken at the same date time for the whole run
+        at_datetime = datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()
         
         # Do tasks
 
         if args.run_jobs or args.run_job or args.force_run_job:
 
+            # Validate fields jobs read of clients and global jobs before connecting to PG and GitLab, invalid clients are skipped
+            invalid_clients = validate_clients_before_run(client_registry, client_registry.client_files_for(single_client_name), acc_yaml_dict, logger, jobs_client_validator)
+            if invalid_clients:
+                errors = True
+
             # Check db vars
             PG_DB_HOST = os.environ.get("PG_DB_HOST")
             if PG_DB_HOST is None:
@@ -111,6 +159,242 @@ if __name__ == "__main__":
             conn = psycopg2.connect(dsn)
             cur = conn.cursor()
 
+            # Load last runs of all jobs at once from jobs_last_run kept by jobs_log inserts, per job checks make no queries
+            sql = """
+            SELECT
+                    client
+            ,       asset_fqdn
+            ,       job_id
+            ,       jobs_script_run_at
+            ,       job_tz
+            FROM
+                    jobs_last_run
+            ;
+            """
+            logger.info("Query:")
+            logger.info(sql)
+            try:
+                cur.execute(sql)
+            except Exception as e:
+                raise Exception("Caught exception on query execution")
+
+            # (client, asset_fqdn, job_id) -> (jobs_script_run_at, job_tz)
+            jobs_last_run = {}
+            for row in cur:
+                jobs_last_run[(row[0], row[1], row[2])] = (row[3], row[4])
+            logger.info("Loaded last runs of {0} jobs".format(len(jobs_last_run)))
+
+            # Load next due times of jobs, jobs are not evaluated before them while their schedule is the same
+            sql = """
+            SELECT
+                    client
+            ,       asset_fqdn
+            ,       job_id
+            ,       schedule_hash
+            ,       next_due_at
+            FROM
+                    jobs_next_due
+            WHERE
+                    next_due_at IS NOT NULL
+            ;
+            """
+            logger.info("Query:")
+            logger.info(sql)
+            try:
+                cur.execute(sql)
+            except Exception as e:
+                raise Exception("Caught exception on query execution")
+
+            # (client, asset_fqdn, job_id) -> (schedule_hash, next_due_at in UTC)
+            jobs_next_due = {}
+            for row in cur:
+                jobs_next_due[(row[0], row[1], row[2])] = (row[3], pytz.utc.localize(row[4]))
+            logger.info("Loaded next due times of {0} jobs".format(len(jobs_next_due)))
+
+            # Next due times of evaluated jobs are saved at once after all jobs
+            jobs_next_due_updates = {}
+
+            # Run pipeline script of job
+            def trigger_job(script):
+                logger.info("Running bash script:")
+                logger.info(script)
+                if not args.dry_run_pipeline:
+                    subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
+
+            # Return (trigger, error, latency) per trigger of salt project, triggers are run in order
+            def trigger_salt_project_jobs(triggers):
+                results = []
+                for trigger in triggers:
+                    started = monotonic()
+                    try:
+                        trigger_job(trigger[5])
+                        error = None
+                    except Exception as e:
+                        error = e
+                    results.append((trigger, error, monotonic() - started))
+                return results
+
+            # Save job logs of triggers as not triggered in one transaction before triggering, returns (client, asset_fqdn, job_id) -> jobs_log id
+            # Job runs once per asset per run, so the key is unique in a batch, rows are matched by columns as RETURNING order is not guaranteed
+            # Pipeline is never left without its job log if the run crashes while triggering
+            def save_pending_jobs_log(triggers):
+                sql = """
+                INSERT INTO
+                        jobs_log
+                        (
+                                jobs_script_run_at
+                        ,       client
+                        ,       asset_fqdn
+                        ,       job_id
+                        ,       job_level
+                        ,       job_type
+                        ,       job_cmd
+                        ,       job_timeout
+                        ,       job_tz
+                        ,       job_triggered
+                        )
+                VALUES
+                        %s
+                RETURNING
+                        client
+                ,       asset_fqdn
+                ,       job_id
+                ,       id
+                ;
+                """
+                logger.info("Query:")
+                logger.info(sql)
+                try:
+                    rows = psycopg2.extras.execute_values(cur, sql, [
+                        (
+                            datetime.strftime(now, "%Y-%m-%d %H:%M:%S"),
+                            client_name,
+                            asset_fqdn,
+                            job["id"],
+                            job["level"],
+                            job["type"],
+                            job["cmd"].strip(" \t\n\r") if "cmd" in job else "",
+                            str(job["timeout"]) if "timeout" in job else "",
+                            job["tz"],
+                            False
+                        )
+                        for client_name, asset_fqdn, job, now, schedule, script in triggers
+                    ], fetch=True)
+                    logger.info("Query execution status:")
+                    logger.info(cur.statusmessage)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    raise Exception("Caught exception on query execution")
+                return {(row[0], row[1], row[2]): row[3] for row in rows}
+
+            # Mark job logs of triggered jobs as triggered, delete job logs of failed triggers and save last runs in one transaction
+            def confirm_jobs_log(triggered, failed_jobs_log_ids):
+                try:
+                    if len(triggered) > 0:
+                        sql = """
+                        UPDATE
+                                jobs_log
+                        SET
+                                job_triggered = TRUE
+                        WHERE
+                                id = ANY(%s)
+                        ;
+                        """
+                        logger.info("Query:")
+                        logger.info(sql)
+                        cur.execute(sql, ([jobs_log_id for trigger, jobs_log_id in triggered],))
+                        logger.info("Query execution status:")
+                        logger.info(cur.statusmessage)
+
+                        sql = """
+                        INSERT INTO
+                                jobs_last_run
+                                (
+                                        client
+                                ,       asset_fqdn
+                                ,       job_id
+                                ,       jobs_log_id
+                                ,       jobs_script_run_at
+                                ,       job_tz
+                                )
+                        VALUES
+                                %s
+                        ON CONFLICT (client, asset_fqdn, job_id) DO UPDATE SET
+                                jobs_log_id = EXCLUDED.jobs_log_id
+                        ,       jobs_script_run_at = EXCLUDED.jobs_script_run_at
+                        ,       job_tz = EXCLUDED.job_tz
+                        ;
+                        """
+                        logger.info("Query:")
+                        logger.info(sql)
+                        psycopg2.extras.execute_values(cur, sql, [
+                            (client_name, asset_fqdn, job["id"], jobs_log_id, datetime.strftime(now, "%Y-%m-%d %H:%M:%S"), job["tz"])
+                            for (client_name, asset_fqdn, job, now, schedule, script), jobs_log_id in triggered
+                        ])
+                        logger.info("Query execution status:")
+                        logger.info(cur.statusmessage)
+
+                    if len(failed_jobs_log_ids) > 0:
+                        sql = """
+                        DELETE FROM
+                                jobs_log
+                        WHERE
+                                id = ANY(%s)
+                        ;
+                        """
+                        logger.info("Query:")
+                        logger.info(sql)
+                        cur.execute(sql, (failed_jobs_log_ids,))
+                        logger.info("Query execution status:")
+                        logger.info(cur.statusmessage)
+
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    raise Exception("Caught exception on query execution, job logs are left not triggered")
+
+            # Trigger jobs of salt projects, in parallel if workers is set, jobs of one salt project are triggered in order
+            # Job logs are saved with one commit before and one commit after triggering, returns (trigger, error, latency) per trigger
+            def run_triggers(salt_project_triggers, workers):
+                triggers = [trigger for salt_project in salt_project_triggers for trigger in salt_project_triggers[salt_project]]
+                if len(triggers) == 0:
+                    return []
+                jobs_log_ids = save_pending_jobs_log(triggers)
+                if workers is None:
+                    results = [result for project_triggers in salt_project_triggers.values() for result in trigger_salt_project_jobs(project_triggers)]
+                else:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                        futures = [executor.submit(trigger_salt_project_jobs, project_triggers) for project_triggers in salt_project_triggers.values()]
+                        results = [result for future in futures for result in future.result()]
+                confirm_jobs_log(
+                    [(trigger, jobs_log_ids[(trigger[0], trigger[1], trigger[2]["id"])]) for trigger, error, latency in results if error is None],
+                    [jobs_log_ids[(trigger[0], trigger[1], trigger[2]["id"])] for trigger, error, latency in results if error is not None]
+                )
+                for (client_name, asset_fqdn, job, now, schedule, script), error, latency in results:
+                    if error is None:
+                        # Print job details
+                        print(
+                            "Job: {client} {asset_fqdn} {job_id} {job_level} {job_type} {job_cmd} {job_timeout}".format(
+                                client=client_name,
+                                asset_fqdn=asset_fqdn,
+                                job_id=job["id"],
+                                job_level=job["level"],
+                                job_type=job["type"],
+                                job_cmd=job["cmd"].rstrip() if "cmd" in job else "",
+                                job_timeout=job["timeout"] if "timeout" in job else ""
+                            )
+                        )
+                        # Keep loaded last runs actual
+                        jobs_last_run[(client_name, asset_fqdn, job["id"])] = (now.replace(tzinfo=None), job["tz"])
+                        jobs_next_due_updates[(client_name, asset_fqdn, job["id"])] = (schedule.schedule_hash, schedule.next_due(now, now))
+                    else:
+                        logger.error("Job {asset}/{job} trigger failed, job log is deleted".format(asset=asset_fqdn, job=job["id"]), exc_info=error)
+                return results
+
+            # Salt project path -> list of (client, asset_fqdn, job, now, schedule, script) to trigger in order
+            salt_project_triggers = {}
+
             # Save now once in UTC
             # We cannot take now() within run jobs loops - each job run takes ~5 secs and thats why now drifts many minutes forward
             saved_now = datetime.now(pytz.timezone("UTC"))
@@ -120,7 +404,11 @@ if __name__ == "__main__":
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.client_files_for(single_client_name):
+
+                # Skip clients failed validation, errors are already logged
+                if client_file in invalid_clients:
+                    continue
 
                 # Client file errors should not stop other clients
                 try:
@@ -128,9 +416,7 @@ if __name__ == "__main__":
                     logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    client_dict = client_registry.load(client_file)
                     
                     # Skip other clients
                     if args.run_jobs:
@@ -143,6 +429,12 @@ if __name__ == "__main__":
                     if run_client != "ALL" and client_dict["name"].lower() != run_client:
                         continue
 
+                    # Skip clients without the asset before querying GitLab, single client is checked on its assets
+                    if run_client == "ALL" and run_asset != "ALL":
+                        indexed_asset = client_registry.find_asset(run_asset)
+                        if indexed_asset is None or indexed_asset.client_dict is not client_dict:
+                            continue
+
                     # Skip disabled clients
                     if not client_dict["active"]:
                         continue
@@ -161,10 +453,8 @@ if __name__ == "__main__":
                     project = gl.projects.get(client_dict["gitlab"]["salt_project"]["path"])
                     logger.info("Salt project {project} for client {client} ssh_url_to_repo: {ssh_url_to_repo}, path_with_namespace: {path_with_namespace}".format(project=client_dict["gitlab"]["salt_project"]["path"], client=client_dict["name"], path_with_namespace=project.path_with_namespace, ssh_url_to_repo=project.ssh_url_to_repo))
 
-                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
-
-                    # For each asset
-                    for asset in asset_list:
+                    # For each asset, tariffs are resolved only for assets with jobs requiring licenses
+                    for asset in client_registry.iter_assets(client_dict, at_datetime):
 
                         # Asset errors should not stop other assets
                         try:
@@ -253,26 +543,11 @@ if __name__ == "__main__":
 
                                     # Take the first (upper and current) tariff
                                     all_tar_lic_list = []
-                                    for asset_tariff in activated_tariff(asset["tariffs"], datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), logger)["tariffs"]:
+                                    for tariff_plan in asset["activated_tariff"]:
 
-                                        # If tariff has file key - load it
-                                        if "file" in asset_tariff:
-                                            
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                                            if tariff_dict is None:
-                                                
-                                                raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
-
-                                            # Add tariff plan licenses to all tariffs lic list if exist
-                                            if "licenses" in tariff_dict:
-                                                all_tar_lic_list.extend(tariff_dict["licenses"])
-
-                                        # Also take inline plan and service
-                                        else:
-
-                                            # Add tariff plan licenses to all tariffs lic list if exist
-                                            if "licenses" in asset_tariff:
-                                                all_tar_lic_list.extend(asset_tariff["licenses"])
+                                        # Add tariff plan licenses to all tariffs lic list if exist
+                                        if "licenses" in tariff_plan:
+                                            all_tar_lic_list.extend(tariff_plan["licenses"])
 
                                     # Search for all needed licenses in tariff licenses and skip if not found
                                     if not all(lic in all_tar_lic_list for lic in job["licenses"]):
@@ -290,38 +565,25 @@ if __name__ == "__main__":
                                 # Job error should not stop other jobs
                                 try:
 
+                                    # Job schedule is compiled once and shared by assets with the same job
+                                    schedule = compiled_schedule(job, MINUTES_JITTER)
+                                    job_key = (client_dict["name"], asset["fqdn"], job["id"])
+
+                                    # Skip jobs which cannot be due before saved next due time
+                                    if not args.force_run_job:
+                                        job_next_due = jobs_next_due.get(job_key)
+                                        if job_next_due is not None and job_next_due[0] == schedule.schedule_hash and saved_now < job_next_due[1]:
+                                            logger.info("Job {asset}/{job} skipped because it is not due until {time}".format(asset=asset["fqdn"], job=job["id"], time=datetime.strftime(job_next_due[1], "%Y-%m-%d %H:%M:%S %z %Z")))
+                                            continue
+
                                     # Make now from saved_now in job timezone
-                                    now = saved_now.astimezone(pytz.timezone(job["tz"]))
+                                    now = saved_now.astimezone(schedule.tz)
                                     logger.info("Job {asset}/{job} now() in job TZ is {now}".format(asset=asset["fqdn"], job=job["id"], now=datetime.strftime(now, "%Y-%m-%d %H:%M:%S %z %Z")))
 
-                                    # Load last job run from jobs_log table
-                                    sql = """
-                                    SELECT
-                                            jobs_script_run_at
-                                    ,       job_tz
-                                    FROM
-                                            jobs_log
-                                    WHERE
-                                            client = '{client}'
-                                    AND
-                                            asset_fqdn = '{asset_fqdn}'
-                                    AND
-                                            job_id = '{job_id}'
-                                    ORDER BY
-                                            id DESC
-                                    LIMIT 1
-                                    ;
-                                    """.format(client=client_dict["name"], asset_fqdn=asset["fqdn"], job_id=job["id"])
-                                    logger.info("Query:")
-                                    logger.info(sql)
-
-                                    cur.execute(sql)
-
-                                    # Get job last run
-                                    if cur.rowcount > 0:
-                                        row = cur.fetchone()
-                                        row_jobs_script_run_at = row[0]
-                                        row_job_tz = row[1]
+                                    # Get job last run loaded from jobs_last_run table
+                                    job_last_run_row = jobs_last_run.get(job_key)
+                                    if job_last_run_row is not None:
+                                        row_jobs_script_run_at, row_job_tz = job_last_run_row
                                         row_offset = datetime.now(pytz.timezone(row_job_tz)).strftime("%z") # now is just for an object
                                         job_last_run_text = datetime.strftime(row_jobs_script_run_at, "%Y-%m-%d %H:%M:%S") + " " + row_offset
                                         job_last_run = datetime.strptime(job_last_run_text, "%Y-%m-%d %H:%M:%S %z")
@@ -341,114 +603,13 @@ if __name__ == "__main__":
                                     else:
 
                                         # Decide if needed to run
+                                        not_due_reason = schedule.not_due_reason(now, job_last_run)
+                                        if not_due_reason is not None:
+                                            logger.info("Job {asset}/{job} skipped because {reason}".format(asset=asset["fqdn"], job=job["id"], reason=not_due_reason))
+                                            jobs_next_due_updates[job_key] = (schedule.schedule_hash, schedule.next_due(now, job_last_run))
+                                            continue
 
-                                        if "each" in job:
-                                            seconds_between_now_and_job_last_run = (now - job_last_run).total_seconds()
-                                            logger.info("Job {asset}/{job} seconds between now and job last run: {secs}".format(asset=asset["fqdn"], job=job["id"], secs=seconds_between_now_and_job_last_run))
-                                            seconds_needed_to_wait = 0-2*MINUTES_JITTER*60
-                                            if "years" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*365*job["each"]["years"]
-                                            if "months" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*31*job["each"]["month"]
-                                            if "weeks" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*7*job["each"]["weeks"]
-                                            if "days" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*job["each"]["days"]
-                                            if "hours" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*job["each"]["hours"]
-                                            if "minutes" in job["each"]:
-                                                seconds_needed_to_wait += 60*job["each"]["minutes"]
-                                            logger.info("Job {asset}/{job} seconds needed to wait from \"each\" key: {secs}".format(asset=asset["fqdn"], job=job["id"], secs=seconds_needed_to_wait))
-                                            if seconds_between_now_and_job_last_run < seconds_needed_to_wait:
-                                                logger.info("Job {asset}/{job} skipped because: {secs1} < {secs2}".format(asset=asset["fqdn"], job=job["id"], secs1=seconds_between_now_and_job_last_run, secs2=seconds_needed_to_wait))
-                                                continue
-
-                                        if "minutes" in job:
-                                            minutes_rewrited = []
-                                            for minutes in job["minutes"]:
-                                                if len(str(minutes).split("-")) > 1:
-                                                    for m in range(int(str(minutes).split("-")[0]), int(str(minutes).split("-")[1])+1):
-                                                        minutes_rewrited.append(m)
-                                                else:
-                                                    # Apply MINUTES_JITTER
-                                                    for m in range(minutes, minutes + MINUTES_JITTER):
-                                                        minutes_rewrited.append(m)
-                                            logger.info("Job {asset}/{job} should be run on minutes: {mins}".format(asset=asset["fqdn"], job=job["id"], mins=minutes_rewrited))
-                                            now_minute = int(datetime.strftime(now, "%M"))
-                                            logger.info("Job {asset}/{job} now minute is: {minute}".format(asset=asset["fqdn"], job=job["id"], minute=now_minute))
-                                            if now_minute not in minutes_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now minute is not in run minutes list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-
-                                        if "hours" in job:
-                                            hours_rewrited = []
-                                            for hours in job["hours"]:
-                                                if len(str(hours).split("-")) > 1:
-                                                    for h in range(int(str(hours).split("-")[0]), int(str(hours).split("-")[1])+1):
-                                                        hours_rewrited.append(h)
-                                                else:
-                                                    hours_rewrited.append(hours)
-                                            logger.info("Job {asset}/{job} should be run on hours: {hours}".format(asset=asset["fqdn"], job=job["id"], hours=hours_rewrited))
-                                            now_hour = int(datetime.strftime(now, "%H"))
-                                            logger.info("Job {asset}/{job} now hour is: {hour}".format(asset=asset["fqdn"], job=job["id"], hour=now_hour))
-                                            if now_hour not in hours_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now hour is not in run hours list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "days" in job:
-                                            days_rewrited = []
-                                            for days in job["days"]:
-                                                if len(str(days).split("-")) > 1:
-                                                    for d in range(int(str(days).split("-")[0]), int(str(days).split("-")[1])+1):
-                                                        days_rewrited.append(d)
-                                                else:
-                                                    days_rewrited.append(days)
-                                            logger.info("Job {asset}/{job} should be run on days: {days}".format(asset=asset["fqdn"], job=job["id"], days=days_rewrited))
-                                            now_day = int(datetime.strftime(now, "%d"))
-                                            logger.info("Job {asset}/{job} now day is: {day}".format(asset=asset["fqdn"], job=job["id"], day=now_day))
-                                            if now_day not in days_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now day is not in run days list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "months" in job:
-                                            months_rewrited = []
-                                            for months in job["months"]:
-                                                if len(str(months).split("-")) > 1:
-                                                    for m in range(int(str(months).split("-")[0]), int(str(months).split("-")[1])+1):
-                                                        months_rewrited.append(m)
-                                                else:
-                                                    months_rewrited.append(months)
-                                            logger.info("Job {asset}/{job} should be run on months: {months}".format(asset=asset["fqdn"], job=job["id"], months=months_rewrited))
-                                            now_month = int(datetime.strftime(now, "%m"))
-                                            logger.info("Job {asset}/{job} now month is: {month}".format(asset=asset["fqdn"], job=job["id"], month=now_month))
-                                            if now_month not in months_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now month is not in run months list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "years" in job:
-                                            years_rewrited = []
-                                            for years in job["years"]:
-                                                if len(str(years).split("-")) > 1:
-                                                    for y in range(int(str(years).split("-")[0]), int(str(years).split("-")[1])+1):
-                                                        years_rewrited.append(y)
-                                                else:
-                                                    years_rewrited.append(years)
-                                            logger.info("Job {asset}/{job} should be run on years: {years}".format(asset=asset["fqdn"], job=job["id"], years=years_rewrited))
-                                            now_year = int(datetime.strftime(now, "%Y"))
-                                            logger.info("Job {asset}/{job} now year is: {year}".format(asset=asset["fqdn"], job=job["id"], year=now_year))
-                                            if now_year not in years_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now year is not in run years list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "weekdays" in job:
-                                            logger.info("Job {asset}/{job} should be run on weekdays: {weekdays}".format(asset=asset["fqdn"], job=job["id"], weekdays=job["weekdays"]))
-                                            now_weekday = datetime.strftime(now, "%a")
-                                            logger.info("Job {asset}/{job} now weekday is: {weekday}".format(asset=asset["fqdn"], job=job["id"], weekday=now_weekday))
-                                            if now_weekday not in job["weekdays"]:
-                                                logger.info("Job {asset}/{job} skipped because now weekday is not in run weekdays list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-
-                                    # Run job
+                                    # Make pipeline script of job
 
                                     if job["type"] == "salt_cmd":
                                         script = textwrap.dedent(
@@ -456,10 +617,6 @@ if __name__ == "__main__":
                                             .gitlab-server-job/pipeline_salt_cmd.sh nowait {salt_project} {timeout} {asset} "{job_cmd}"
                                             """
                                         ).format(salt_project=client_dict["gitlab"]["salt_project"]["path"], timeout=job["timeout"], asset=asset["fqdn"], job_cmd=job["cmd"])
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
                                     elif job["type"] == "rsnapshot_backup_ssh":
                                         
                                         # Decide which connect host:port to use
@@ -491,84 +648,17 @@ if __name__ == "__main__":
                                             .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} 0 {asset} SSH {ssh_host} {ssh_port} {ssh_jump}
                                             """
                                         ).format(salt_project=client_dict["gitlab"]["salt_project"]["path"], asset=asset["fqdn"], ssh_host=ssh_host, ssh_port=ssh_port, ssh_jump=ssh_jump)
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
                                     elif job["type"] == "rsnapshot_backup_salt":
                                         script = textwrap.dedent(
                                             """
                                             .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} {timeout} {asset} SALT
                                             """
                                         ).format(salt_project=client_dict["gitlab"]["salt_project"]["path"], timeout=job["timeout"], asset=asset["fqdn"])
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
                                     else:
                                         raise Exception("Unknown job type: {jtype}".format(jtype=job["type"]))
 
-                                    # Print job details
-                                    print(
-                                        "Job: {client} {asset_fqdn} {job_id} {job_level} {job_type} {job_cmd} {job_timeout}".format(
-                                            client=client_dict["name"],
-                                            asset_fqdn=asset["fqdn"],
-                                            job_id=job["id"],
-                                            job_level=job["level"],
-                                            job_type=job["type"],
-                                            job_cmd=job["cmd"].rstrip() if "cmd" in job else "",
-                                            job_timeout=job["timeout"] if "timeout" in job else ""
-                                        )
-                                    )
-
-                                    # Save job log
-                                    sql = """
-                                    INSERT INTO
-                                            jobs_log
-                                            (
-                                                    jobs_script_run_at
-                                            ,       client
-                                            ,       asset_fqdn
-                                            ,       job_id
-                                            ,       job_level
-                                            ,       job_type
-                                            ,       job_cmd
-                                            ,       job_timeout
-                                            ,       job_tz
-                                            )
-                                    VALUES
-                                            (
-                                                    '{jobs_script_run_at}'
-                                            ,       '{client}'
-                                            ,       '{asset_fqdn}'
-                                            ,       '{job_id}'
-                                            ,       '{job_level}'
-                                            ,       '{job_type}'
-                                            ,       TRIM(e'\t\n\r\ ' FROM CONVERT_FROM(DECODE('{job_cmd_base64}', 'BASE64'), 'UTF-8'))
-                                            ,       '{job_timeout}'
-                                            ,       '{job_tz}'
-                                            )
-                                    ;
-                                    """.format(
-                                        jobs_script_run_at=datetime.strftime(now, "%Y-%m-%d %H:%M:%S"),
-                                        client=client_dict["name"],
-                                        asset_fqdn=asset["fqdn"],
-                                        job_id=job["id"],
-                                        job_level=job["level"],
-                                        job_type=job["type"],
-                                        job_cmd_base64=base64.b64encode(job["cmd"].encode("ascii")).decode("ascii") if "cmd" in job else "",
-                                        job_timeout=job["timeout"] if "timeout" in job else "",
-                                        job_tz=job["tz"]
-                                    )
-                                    logger.info("Query:")
-                                    logger.info(sql)
-                                    try:
-                                        cur.execute(sql)
-                                        logger.info("Query execution status:")
-                                        logger.info(cur.statusmessage)
-                                        conn.commit()
-                                    except Exception as e:
-                                        raise Exception("Caught exception on query execution")
+                                    # Pipelines are triggered after all jobs of client are evaluated, or after all jobs with trigger workers
+                                    salt_project_triggers.setdefault(client_dict["gitlab"]["salt_project"]["path"], []).append((client_dict["name"], asset["fqdn"], job, now, schedule, script))
                                 
                                 except Exception as e:
                                     logger.error("Caught exception, but not interrupting")
@@ -585,6 +675,82 @@ if __name__ == "__main__":
                     logger.exception(e)
                     errors = True
 
+                # Trigger jobs of client one by one
+                if trigger_workers is None:
+                    try:
+                        if any(error is not None for trigger, error, latency in run_triggers(salt_project_triggers, None)):
+                            errors = True
+                    except Exception as e:
+                        logger.error("Caught exception, but not interrupting")
+                        logger.exception(e)
+                        errors = True
+                    salt_project_triggers = {}
+
+            # Trigger pipelines of salt projects in parallel, jobs of one salt project are triggered in order
+            # Job log is confirmed only for successfully triggered jobs
+            if trigger_workers is not None and len(salt_project_triggers) > 0:
+
+                triggers_started = monotonic()
+                trigger_latencies = []
+                try:
+                    for (client_name, asset_fqdn, job, now, schedule, script), error, latency in run_triggers(salt_project_triggers, trigger_workers):
+                        if error is not None:
+                            errors = True
+                        trigger_latencies.append((client_name, asset_fqdn, job["id"], error is None, latency))
+                except Exception as e:
+                    logger.error("Caught exception, but not interrupting")
+                    logger.exception(e)
+                    errors = True
+                triggers_wall_time = monotonic() - triggers_started
+
+                # Print trigger latency summary
+                if len(trigger_latencies) > 0:
+                    for client_name, asset_fqdn, job_id, triggered, latency in trigger_latencies:
+                        print("Trigger: {client} {asset_fqdn} {job_id} {status} {latency:.2f}s".format(client=client_name, asset_fqdn=asset_fqdn, job_id=job_id, status="OK" if triggered else "FAILED", latency=latency))
+                    print("Triggered {ok} of {total} jobs in {projects} salt projects with {workers} workers in {wall:.2f}s, max latency {max_latency:.2f}s, avg latency {avg_latency:.2f}s".format(
+                        ok=sum(1 for trigger_latency in trigger_latencies if trigger_latency[3]),
+                        total=len(trigger_latencies),
+                        projects=len(salt_project_triggers),
+                        workers=trigger_workers,
+                        wall=triggers_wall_time,
+                        max_latency=max(trigger_latency[4] for trigger_latency in trigger_latencies),
+                        avg_latency=sum(trigger_latency[4] for trigger_latency in trigger_latencies) / len(trigger_latencies)
+                    ))
+
+            # Save next due times of evaluated jobs in one statement, next_due_at is in UTC
+            if len(jobs_next_due_updates) > 0:
+                sql = """
+                INSERT INTO
+                        jobs_next_due
+                        (
+                                client
+                        ,       asset_fqdn
+                        ,       job_id
+                        ,       schedule_hash
+                        ,       next_due_at
+                        )
+                VALUES
+                        %s
+                ON CONFLICT (client, asset_fqdn, job_id) DO UPDATE SET
+                        schedule_hash = EXCLUDED.schedule_hash
+                ,       next_due_at = EXCLUDED.next_due_at
+                ;
+                """
+                logger.info("Query:")
+                logger.info(sql)
+                try:
+                    psycopg2.extras.execute_values(cur, sql, [
+                        (job_key[0], job_key[1], job_key[2], schedule_hash, next_due_at.astimezone(pytz.utc).replace(tzinfo=None) if next_due_at is not None else None)
+                        for job_key, (schedule_hash, next_due_at) in jobs_next_due_updates.items()
+                    ])
+                    logger.info("Query execution status:")
+                    logger.info(cur.statusmessage)
+                    conn.commit()
+                except Exception as e:
+                    logger.error("Caught exception on query execution, but not interrupting")
+                    logger.exception(e)
+                    errors = True
+
             # Close connection
             cur.close()
             conn.close()
@@ -600,7 +766,7 @@ if __name__ == "__main__":
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.client_files_for(single_client_name):
 
                 # Client file errors should not stop other clients
                 try:
@@ -608,9 +774,7 @@ if __name__ == "__main__":
                     logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                    if client_dict is None:
-                        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                    client_dict = client_registry.load(client_file)
                     
                     # Skip other clients
                     prune_client, prune_age = args.prune_run_tags
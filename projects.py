@@ -26,6 +26,8 @@ CLIENTS_SUBDIR = "clients"
 YAML_GLOB = "*.yaml"
 YAML_EXT = "yaml"
 ACC_YAML = "accounting.yaml"
+SNAPSHOT_SUBDIR = ".snapshot"
+CLIENT_INDEX_FILE = "client_index.json"
 PROJECTS_SUBDIR = ".projects"
 
 # Funcs
@@ -42,6 +44,27 @@ def open_file(d, f, mode):
                 raise
     return open("{0}/{1}".format(d, f), mode)
 
+# Client files the command processes: of client_name if set, active, having gitlab project_key if set, by inclusions and exclusions
+def processed_client_files(client_registry, client_files, client_name, project_key, args, include_clients_list, exclude_clients_list):
+    processed_files = []
+    for client_file in client_files:
+        # Clients are not validated yet, missing keys are left to validation
+        client_dict = client_registry.load(client_file)
+        client_dict_name = str(client_dict.get("name", "")).lower()
+        if client_name is not None and client_dict_name != client_name:
+            continue
+        if not client_dict.get("active") or (project_key is not None and project_key not in (client_dict.get("gitlab") or {})):
+            continue
+        if (
+                (args.exclude_clients is not None and client_dict_name not in exclude_clients_list)
+                or
+                (args.include_clients is not None and client_dict_name in include_clients_list)
+                or
+                (args.exclude_clients is None and args.include_clients is None)
+            ):
+            processed_files.append(client_file)
+    return processed_files
+
 # Main
 
 if __name__ == "__main__":
@@ -56,6 +79,8 @@ if __name__ == "__main__":
     parser.add_argument("--dry-run-gitlab", dest="dry_run_gitlab", help="no new objects created in gitlab", action="store_true")
     parser.add_argument("--gitlab-runner-registration-token", dest="gitlab_runner_registration_token", help="set gitlab runner registration token for template if you do not have maintainer rights to get it with code", nargs=1, metavar=("TOKEN"))
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--parse-workers", dest="parse_workers", help="parse client yamls in N parallel processes if there is no actual config snapshot", nargs=1, metavar=("N"))
+    parser.add_argument("--affected-since-snapshot", dest="affected_since_snapshot", help="run --template-salt-project-for-all-clients, --update-admin-project-wiki-for-all-clients only for clients affected by config changes since config snapshot HASH", nargs=1, metavar=("HASH"))
     group = parser.add_mutually_exclusive_group(required=False)
     group.add_argument("--exclude-clients", dest="exclude_clients", help="exclude clients defined by JSON_LIST from all-clients operations", nargs=1, metavar=("JSON_LIST"))
     group.add_argument("--include-clients", dest="include_clients", help="include only clients defined by JSON_LIST for all-clients operations", nargs=1, metavar=("JSON_LIST"))
@@ -94,10 +119,49 @@ if __name__ == "__main__":
         # Chdir to work dir
         os.chdir(WORK_DIR)
 
-        # Read ACC_YAML
-        acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
-        if acc_yaml_dict is None:
-            raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+        # Parse client files in parallel if requested
+        parse_workers = int(args.parse_workers[0]) if args.parse_workers is not None else None
+
+        # Client of single client commands, None for all clients
+        single_client_name = None
+        for client_args in [args.template_salt_project_for_client]:
+            if client_args is not None:
+                single_client_name = client_args[0]
+
+        # Registry to fall back to if snapshot cannot be built
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, index_file="{0}/{1}/{2}".format(WORK_DIR, SNAPSHOT_SUBDIR, CLIENT_INDEX_FILE))
+
+        # Load compiled config snapshot, it is rebuilt if any of config files changed
+        # Single client commands parse only the needed client using client index instead
+        if single_client_name is None:
+            config_snapshot = load_config_snapshot(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, SNAPSHOT_SUBDIR, logger, parse_workers, client_registry)
+        else:
+            config_snapshot = None
+
+        if config_snapshot is not None:
+
+            acc_yaml_dict = config_snapshot["acc_yaml"]
+
+            # Client files are already loaded in snapshot
+            client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, config_snapshot["clients"], config_snapshot["deps"])
+
+        else:
+
+            # Read ACC_YAML
+            acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+            if acc_yaml_dict is None:
+                raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+
+            # Client files are loaded once per run, clients parsed by failed snapshot build are reused
+            if parse_workers is not None:
+                client_registry.preload(parse_workers)
+
+        # Select only clients affected by config changes since snapshot
+        if args.affected_since_snapshot is not None:
+            client_registry.select(affected_client_files(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, TARIFFS_SUBDIR, SNAPSHOT_SUBDIR, args.affected_since_snapshot[0], client_registry, logger))
+
+        # Tariffs are taken at the same date time for the whole run
+        at_datetime = datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()
         
         # Do tasks
 
@@ -115,19 +179,23 @@ if __name__ == "__main__":
 
         if args.setup_projects_for_client is not None or args.setup_projects_for_all_clients:
             
+            # Validate clients processed below before any GitLab work
+            validate_client_name = args.setup_projects_for_client[0] if args.setup_projects_for_client is not None else None
+            validate_client_files = processed_client_files(client_registry, client_registry.client_files_for(validate_client_name), validate_client_name, None, args, include_clients_list, exclude_clients_list)
+            if validate_clients_before_run(client_registry, validate_client_files, acc_yaml_dict, logger):
+                raise Exception("Client validation failed, see errors above")
+
             # Connect to GitLab
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.client_files:
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
                 
                 # Check specific client
                 if args.setup_projects_for_client is not None:
@@ -328,19 +396,23 @@ if __name__ == "__main__":
 
         if args.clone_project_for_client is not None or args.clone_project_for_all_clients:
             
+            # Validate clients processed below before any GitLab work
+            validate_client_name = args.clone_project_for_client[0] if args.clone_project_for_client is not None else None
+            validate_client_files = processed_client_files(client_registry, client_registry.client_files_for(validate_client_name), validate_client_name, "salt_project", args, include_clients_list, exclude_clients_list)
+            if validate_clients_before_run(client_registry, validate_client_files, acc_yaml_dict, logger):
+                raise Exception("Client validation failed, see errors above")
+
             # Connect to GitLab
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.client_files:
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
                 
                 # Check specific client
                 if args.clone_project_for_client is not None:
@@ -414,19 +486,22 @@ if __name__ == "__main__":
 
         if args.template_salt_project_for_client is not None or args.template_salt_project_for_all_clients:
             
+            # Validate clients processed below before any GitLab work
+            validate_client_files = processed_client_files(client_registry, client_registry.client_files_for(single_client_name), single_client_name, "salt_project", args, include_clients_list, exclude_clients_list)
+            if validate_clients_before_run(client_registry, validate_client_files, acc_yaml_dict, logger):
+                raise Exception("Client validation failed, see errors above")
+
             # Connect to GitLab
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.client_files_for(single_client_name):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
                 
                 # Check specific client
                 if args.template_salt_project_for_client is not None:
@@ -507,18 +582,16 @@ if __name__ == "__main__":
                     # Add self assets
                     template_var_asset_dicts["_self"], \
                         template_var_asset_tariffs["_self"], \
-                        template_var_asset_licenses["_self"] = get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                        template_var_asset_licenses["_self"] = get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime)
 
                     # Check sub_clients before adding
                     if "sub_clients" in client_dict["configuration_management"]:
 
                         # For *.yaml in client dir
-                        for template_var_client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+                        for template_var_client_file in client_registry.client_files:
 
                             # Load client YAML
-                            template_var_client_dict = load_client_yaml(WORK_DIR, template_var_client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                            if template_var_client_dict is None:
-                                raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, template_var_client_file))
+                            template_var_client_dict = client_registry.load(template_var_client_file)
 
                             if template_var_client_dict["active"]:
 
@@ -530,7 +603,7 @@ if __name__ == "__main__":
 
                                     template_var_asset_dicts[template_var_client_dict["name"]], \
                                         template_var_asset_tariffs[template_var_client_dict["name"]], \
-                                        template_var_asset_licenses[template_var_client_dict["name"]] = get_active_assets(template_var_client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                                        template_var_asset_licenses[template_var_client_dict["name"]] = get_active_assets(template_var_client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime)
 
                                     logger.info("Added client to template: {0}".format(template_var_client_file))
 
@@ -765,7 +838,7 @@ if __name__ == "__main__":
                         # It is needed for both salt and salt-ssh types
                         client_asset_list = ""
 
-                        for asset in sorted(get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()), key = lambda x: (x["tariffs"][-1]["activated"], x["fqdn"])):
+                        for asset in sorted(client_registry.asset_list(client_dict, at_datetime), key = lambda x: (x["tariffs"][-1]["activated"], x["fqdn"])):
 
                             # Add only servers to roster
                             if asset["kind"] == "server":
@@ -826,7 +899,7 @@ if __name__ == "__main__":
                         
                         pillar_dirname = PROJECTS_SUBDIR + "/" + project.path_with_namespace + "/pillar/salt"
                         
-                        for asset in get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()):
+                        for asset in client_registry.asset_list(client_dict, at_datetime):
 
                             if asset["active"] and asset["kind"] == "server" and "minion" in asset:
                                 
@@ -899,7 +972,7 @@ if __name__ == "__main__":
                             pillar_master_dict["salt"]["master"]["pki"]["minions"][salt_master["fqdn"]] = pss(salt_master["pki"]["minion"]["pub"])
 
                             # Other active assets accepted Minions on Master
-                            for asset in get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()):
+                            for asset in client_registry.asset_list(client_dict, at_datetime):
                                 if asset["active"] and asset["kind"] == "server" and "minion" in asset:
                                     pillar_master_dict["salt"]["master"]["pki"]["minions"][asset["fqdn"]] = pss(asset["minion"]["pub"])
 
@@ -989,19 +1062,23 @@ if __name__ == "__main__":
 
         if args.update_admin_project_wiki_for_client is not None or args.update_admin_project_wiki_for_all_clients:
 
+            # Validate clients processed below before any GitLab work
+            validate_client_name = args.update_admin_project_wiki_for_client[0] if args.update_admin_project_wiki_for_client is not None else None
+            validate_client_files = processed_client_files(client_registry, client_registry.client_files_for(validate_client_name), validate_client_name, "admin_project", args, include_clients_list, exclude_clients_list)
+            if validate_clients_before_run(client_registry, validate_client_files, acc_yaml_dict, logger):
+                raise Exception("Client validation failed, see errors above")
+
             # Connect to GitLab
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.client_files_for(single_client_name):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
 
                 # Check specific client
                 if args.update_admin_project_wiki_for_client is not None:
@@ -1075,7 +1152,7 @@ if __name__ == "__main__":
                     subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
 
                     asset_list_text = ""
-                    asset_list = sorted(get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()), key = lambda x: (x["tariffs"][-1]["activated"]))
+                    asset_list = sorted(client_registry.asset_list(client_dict, at_datetime), key = lambda x: (x["tariffs"][-1]["activated"]))
 
                     # Iterate over assets
                     for asset in asset_list:
@@ -27,6 +27,8 @@ TARIFFS_SUBDIR = "tariffs"
 YAML_GLOB = "*.yaml"
 YAML_EXT = "yaml"
 ACC_YAML = "accounting.yaml"
+SNAPSHOT_SUBDIR = ".snapshot"
+CLIENT_INDEX_FILE = "client_index.json"
 
 # Main
 
@@ -44,6 +46,7 @@ if __name__ == "__main__":
                           help="ignore jobs_disabled if set in yaml",
                           action="store_true")
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--parse-workers", dest="parse_workers", help="parse client yamls in N parallel processes if there is no actual config snapshot", nargs=1, metavar=("N"))
 
     group = parser.add_mutually_exclusive_group(required=False)
     group.add_argument("--exclude-clients",
@@ -93,10 +96,45 @@ if __name__ == "__main__":
         # Chdir to work dir
         os.chdir(WORK_DIR)
 
-        # Read ACC_YAML
-        acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
-        if acc_yaml_dict is None:
-            raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+        # Parse client files in parallel if requested
+        parse_workers = int(args.parse_workers[0]) if args.parse_workers is not None else None
+
+        # Client of single client commands, None for all clients
+        single_client_name = None
+        for client_args in [args.pipeline_salt_cmd_for_asset_for_client, args.pipeline_salt_cmd_for_all_assets_for_client]:
+            if client_args is not None:
+                single_client_name = client_args[0]
+
+        # Registry to fall back to if snapshot cannot be built
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, index_file="{0}/{1}/{2}".format(WORK_DIR, SNAPSHOT_SUBDIR, CLIENT_INDEX_FILE))
+
+        # Load compiled config snapshot, it is rebuilt if any of config files changed
+        # Single client commands parse only the needed client using client index instead
+        if single_client_name is None:
+            config_snapshot = load_config_snapshot(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, SNAPSHOT_SUBDIR, logger, parse_workers, client_registry)
+        else:
+            config_snapshot = None
+
+        if config_snapshot is not None:
+
+            acc_yaml_dict = config_snapshot["acc_yaml"]
+
+            # Client files are already loaded in snapshot
+            client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, config_snapshot["clients"], config_snapshot["deps"])
+
+        else:
+
+            # Read ACC_YAML
+            acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+            if acc_yaml_dict is None:
+                raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+
+            # Client files are loaded once per run, clients parsed by failed snapshot build are reused
+            if parse_workers is not None:
+                client_registry.preload(parse_workers)
+
+        # Tariffs are taken at the same date time for the whole run
+        at_datetime = datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()
         
         # Do tasks
 
@@ -115,14 +153,12 @@ if __name__ == "__main__":
         if args.pipeline_salt_cmd_for_asset_for_client or args.pipeline_salt_cmd_for_all_assets_for_client or args.pipeline_salt_cmd_for_all_assets_for_all_clients:
             
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.client_files_for(single_client_name):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
-                if client_dict is None:
-                    raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+                client_dict = client_registry.load(client_file)
                 
                 # Unpack oarams and select client if needed
                 needed_asset = None
@@ -166,8 +202,6 @@ if __name__ == "__main__":
                     if not args.ignore_jobs_disabled and "jobs_disabled" in client_dict and client_dict["jobs_disabled"]:
                         continue
             
-                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
-
                     # Threaded function
                     def pipeline_salt_cmd(salt_project, asset, cmd):
                         script = textwrap.dedent(
@@ -194,7 +228,7 @@ if __name__ == "__main__":
                         ))
 
                     # For each asset
-                    for asset in asset_list:
+                    for asset in client_registry.iter_assets(client_dict, at_datetime):
                         
                         # Pipelines are only for servers
                         if asset["kind"] == "server":
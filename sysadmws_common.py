@@ -8,12 +8,29 @@ import yaml
 import logging
 from logging.handlers import RotatingFileHandler
 from collections import OrderedDict
+from collections.abc import Mapping
 import json
 import argparse
 import glob
+import copy
+import re
+import bisect
+import hashlib
+import pickle
+import tempfile
+import concurrent.futures
+import subprocess
 from datetime import datetime
 from datetime import time
+from datetime import date
+from datetime import timedelta
 from mergedeep import merge
+import pytz
+# Use libyaml based loader if PyYAML is built with it, it is much faster on big client files
+try:
+    from yaml import CSafeLoader as YAMLSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLSafeLoader
 #import pdb
 
 # Custom Exceptions
@@ -49,11 +66,51 @@ def load_yaml(f, l):
     l.info("Loading YAML from file {0}".format(f))
     try:
         with open(f, 'r') as yaml_file:
-            yaml_dict = yaml.load(yaml_file, Loader=yaml.SafeLoader)
+            yaml_dict = yaml.load(yaml_file, Loader=YAMLSafeLoader)
     except:
         raise LoadError("Reading YAML from file '{0}' failed".format(f))
     return yaml_dict
 
+# Parsed tariff files per process: path -> ((mtime, size), dict)
+tariff_cache = {}
+
+# Load tariff YAML once per process, reparse only if file mtime or size changed
+# Returns tariff file path, its (mtime, size) and cached dict which must not be changed
+def load_cached_tariff(WORK_DIR, TARIFFS_SUBDIR, f, logger):
+    tariff_file = "{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, f)
+    try:
+        tariff_stat = os.stat(tariff_file)
+    except:
+        raise LoadError("Reading YAML from file '{0}' failed".format(tariff_file))
+    tariff_key = (tariff_stat.st_mtime_ns, tariff_stat.st_size)
+    if tariff_file not in tariff_cache or tariff_cache[tariff_file][0] != tariff_key:
+        tariff_cache[tariff_file] = (tariff_key, load_yaml(tariff_file, logger))
+    else:
+        logger.info("Loading YAML from cache for file {0}".format(tariff_file))
+    return tariff_file, tariff_key, tariff_cache[tariff_file][1]
+
+# Load tariff YAML, callers get a deep copy, so they can mutate it without poisoning the cache
+def load_tariff(WORK_DIR, TARIFFS_SUBDIR, f, logger):
+    return copy.deepcopy(load_cached_tariff(WORK_DIR, TARIFFS_SUBDIR, f, logger)[2])
+
+# Shared TariffPlan objects per process: tariff file -> ((mtime, size), TariffPlan)
+tariff_plans = {}
+
+# Load tariff YAML as TariffPlan shared by all assets with this tariff file, None if file is empty
+def load_tariff_plan(WORK_DIR, TARIFFS_SUBDIR, f, logger):
+    tariff_file, tariff_key, tariff_dict = load_cached_tariff(WORK_DIR, TARIFFS_SUBDIR, f, logger)
+    if tariff_dict is None:
+        return None
+    if tariff_file not in tariff_plans or tariff_plans[tariff_file][0] != tariff_key:
+        tariff_plans[tariff_file] = (tariff_key, TariffPlan(tariff_dict))
+    return tariff_plans[tariff_file][1]
+
+# Put already parsed tariff dicts (e.g. from config snapshot) to tariff cache
+def seed_tariff_cache(tariff_dicts):
+    for tariff_file, tariff_dict in tariff_dicts.items():
+        tariff_stat = os.stat(tariff_file)
+        tariff_cache[tariff_file] = ((tariff_stat.st_mtime_ns, tariff_stat.st_size), tariff_dict)
+
 # Load FILE
 def load_file_string(f, l):
     l.info("Loading string from file {0}".format(f))
@@ -82,20 +139,84 @@ def set_logger(console_level, log_dir, log_file):
     logger.addHandler(console_handler)
     return logger
 
+# Tariff history of an asset, activation date times are precomputed in ascending order for bisect lookups
+class TariffTimeline:
+
+    def __init__(self, tariffs):
+        # Tariffs in yaml go from the newest (upper and current) to the oldest
+        self.tariffs = tariffs
+        self.activated_date_times = []
+        for tariff in reversed(tariffs):
+            tariff_date_time = datetime.combine(tariff["activated"], time.min)
+            if len(self.activated_date_times) > 0 and tariff_date_time < self.activated_date_times[-1]:
+                raise Exception("Tariffs are not sorted from the newest to the oldest activated date: {0} is above {1}".format(tariff["activated"], self.activated_date_times[-1].date()))
+            self.activated_date_times.append(tariff_date_time)
+
+    # Find tariff activated for event date time, return it with its activated and added dates
+    def lookup(self, event_date_time):
+        # Event datetime must be later than tariff datetime, the newest of such tariffs is taken
+        activated_count = bisect.bisect_right(self.activated_date_times, event_date_time)
+        if activated_count == 0:
+            raise Exception("Event date time {0} out of available tariffs date time".format(event_date_time))
+        event_tariff = self.tariffs[len(self.tariffs) - activated_count]
+        return event_tariff, event_tariff["activated"], event_tariff.get("added")
+
+# Built timelines per process: id of tariffs list -> (tariffs list, length, timeline)
+tariff_timelines = {}
+
+# Get timeline for asset tariffs list, built once per list
+def tariff_timeline(tariffs):
+    cached = tariff_timelines.get(id(tariffs))
+    if cached is None or cached[0] is not tariffs or cached[1] != len(tariffs):
+        cached = (tariffs, len(tariffs), TariffTimeline(tariffs))
+        tariff_timelines[id(tariffs)] = cached
+    return cached[2]
+
+# Activated date times of many tariffs lists flattened into one table to resolve many (asset, event date time) pairs in one sweep
+# Assets are referred by their position in tariffs_lists
+class TariffBatchResolver:
+
+    def __init__(self, tariffs_lists):
+        self.tariffs_lists = list(tariffs_lists)
+        # Activated date times of asset i are ascending in activated_date_times[offsets[i]:offsets[i + 1]]
+        self.offsets = [0]
+        self.activated_date_times = []
+        for tariffs in self.tariffs_lists:
+            self.activated_date_times.extend(tariff_timeline(tariffs).activated_date_times)
+            self.offsets.append(len(self.activated_date_times))
+
+    # Return index in tariffs list of asset activated for event date time, per pair
+    # Pairs are sorted by asset and event date time, so activated date times of each asset are swept once for all its pairs
+    def resolve(self, asset_ids, event_date_times):
+        asset_ids = list(asset_ids)
+        event_date_times = list(event_date_times)
+        tariff_indexes = [None] * len(asset_ids)
+        sweep_asset_id = None
+        for pair_index in sorted(range(len(asset_ids)), key=lambda pair_index: (asset_ids[pair_index], event_date_times[pair_index])):
+            asset_id, event_date_time = asset_ids[pair_index], event_date_times[pair_index]
+            # Start sweep from the oldest tariff of the next asset
+            if asset_id != sweep_asset_id:
+                sweep_asset_id = asset_id
+                position = self.offsets[asset_id]
+            # Event datetime must be later than tariff datetime, move past all tariffs activated by event date time
+            while position < self.offsets[asset_id + 1] and self.activated_date_times[position] <= event_date_time:
+                position += 1
+            activated_count = position - self.offsets[asset_id]
+            if activated_count == 0:
+                raise Exception("Event date time {0} out of available tariffs date time".format(event_date_time))
+            tariff_indexes[pair_index] = len(self.tariffs_lists[asset_id]) - activated_count
+        return tariff_indexes
+
+    # Return tariffs list entries activated for event date time, per pair
+    def entries(self, asset_ids, event_date_times):
+        asset_ids = list(asset_ids)
+        return [self.tariffs_lists[asset_id][tariff_index] for asset_id, tariff_index in zip(asset_ids, self.resolve(asset_ids, event_date_times))]
+
 # Helps to find tariff in tariffs list which is activated for event date
 def activated_tariff(tariffs, event_date_time, logger):
-    event_tariff = None
-    for tariff in tariffs:
-        tariff_date_time = datetime.combine(tariff["activated"], time.min)
-        # Event datetime must be later than tariff datetime
-        if event_date_time >= tariff_date_time:
-            event_tariff = tariff
-            break
-    if event_tariff is not None:
-        logger.info("Found activated tariff {0} for event date time {1}".format(event_tariff, event_date_time))
-        return event_tariff
-    else:
-        raise Exception("Event date time {0} out of available tariffs date time".format(event_date_time))
+    event_tariff, event_tariff_activated, event_tariff_added = tariff_timeline(tariffs).lookup(event_date_time)
+    logger.info("Found activated tariff {0} for event date time {1}".format(event_tariff, event_date_time))
+    return event_tariff
 
 def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime):
 
@@ -110,7 +231,8 @@ def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime
 
         if asset["active"]:
 
-            assets[asset["fqdn"]] = asset
+            # Templates get plain dicts as before, Asset and TariffPlan mappings have no update() and are not JSON serializable
+            assets[asset["fqdn"]] = dict(asset, activated_tariff=[dict(tariff_plan) for tariff_plan in asset["activated_tariff"]])
             tariffs[asset["fqdn"]] = []
             licenses[asset["fqdn"]] = []
 
@@ -120,7 +242,7 @@ def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime
                 # If tariff has file key - load it
                 if "file" in asset_tariff:
 
-                    tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
+                    tariff_dict = load_tariff(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
                     if tariff_dict is None:
                         raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
 
@@ -143,8 +265,8 @@ def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime
 
     return assets, tariffs, licenses
 
-# Get asset list
-def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, only_active=True):
+# Get raw asset dicts of client as they are in yaml, including not active ones
+def client_raw_asset_list(client_dict):
 
     # Prepare asset list from servers (deprecated) and assets
     asset_list_to_process = []
@@ -153,10 +275,123 @@ def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, o
     if "assets" in client_dict:
         asset_list_to_process.extend(client_dict["assets"])
 
-    # Include salt masters in list
-    if client_dict["configuration_management"]["type"] == "salt":
+    # Include salt masters in list, not active clients may have no configuration management
+    if client_dict.get("configuration_management", {}).get("type") == "salt":
         asset_list_to_process.extend(client_dict["configuration_management"]["salt"]["masters"])
 
+    return asset_list_to_process
+
+# Intern strings repeated across many assets, other values are returned as is
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+# Read-only mapping over YAML fields, attributes can't be set after init
+# Values are shared with YAML dicts and caches, nested dicts and lists must not be changed either
+class FrozenMapping(Mapping):
+
+    __slots__ = ("_fields",)
+
+    def __init__(self, fields):
+        object.__setattr__(self, "_fields", fields)
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{0} is immutable".format(type(self).__name__))
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, self._fields)
+
+# Tariff plan from tariff file or inline asset tariff
+class TariffPlan(FrozenMapping):
+
+    __slots__ = ("service", "plan", "revision")
+
+    def __init__(self, tariff_dict):
+        fields = dict(tariff_dict)
+        for key in ["service", "plan"]:
+            if key in fields:
+                fields[key] = intern_str(fields[key])
+        super().__init__(fields)
+        object.__setattr__(self, "service", fields.get("service"))
+        object.__setattr__(self, "plan", fields.get("plan"))
+        object.__setattr__(self, "revision", fields.get("revision"))
+
+# Get activated tariff plans of asset for date time
+def get_asset_activated_tariff(asset, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime):
+
+    asset_activated_tariff = []
+    for asset_tariff in activated_tariff(asset["tariffs"], at_datetime, logger)["tariffs"]:
+
+        # If tariff has file key - load it
+        if "file" in asset_tariff:
+
+            tariff_plan = load_tariff_plan(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
+            if tariff_plan is None:
+
+                raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+
+            asset_activated_tariff.append(tariff_plan)
+
+        # Also take inline plan and service
+        else:
+
+           asset_activated_tariff.append(TariffPlan(asset_tariff))
+
+    return tuple(asset_activated_tariff)
+
+# Asset with default kind computed once, raw asset dict is not changed
+# Activated tariff plans are either given or resolved on first access with tariff_args (WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime)
+class Asset(FrozenMapping):
+
+    __slots__ = ("fqdn", "kind", "active", "os", "location", "_activated_tariff", "_tariff_args")
+
+    def __init__(self, asset_dict, activated_tariff=None, tariff_args=None):
+        fields = dict(asset_dict)
+        for key in ["fqdn", "os", "location"]:
+            if key in fields:
+                fields[key] = intern_str(fields[key])
+        # Default kind: server
+        fields["kind"] = intern_str(fields.get("kind", "server"))
+        super().__init__(fields)
+        object.__setattr__(self, "fqdn", fields["fqdn"])
+        object.__setattr__(self, "kind", fields["kind"])
+        object.__setattr__(self, "active", fields.get("active"))
+        object.__setattr__(self, "os", fields.get("os"))
+        object.__setattr__(self, "location", fields.get("location"))
+        object.__setattr__(self, "_activated_tariff", tuple(activated_tariff) if activated_tariff is not None else None)
+        object.__setattr__(self, "_tariff_args", tariff_args)
+
+    @property
+    def activated_tariff(self):
+        if self._activated_tariff is None:
+            object.__setattr__(self, "_activated_tariff", get_asset_activated_tariff(self._fields, *self._tariff_args))
+        return self._activated_tariff
+
+    def __getitem__(self, key):
+        if key == "activated_tariff":
+            return self.activated_tariff
+        return self._fields[key]
+
+    def __iter__(self):
+        yield from self._fields
+        yield "activated_tariff"
+
+    def __len__(self):
+        return len(self._fields) + 1
+
+# Get asset list
+def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, only_active=True):
+
+    asset_list_to_process = client_raw_asset_list(client_dict)
+
     asset_list = []
     # Set additional or default fields in assets
 
@@ -167,134 +402,1146 @@ def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, o
             if not asset["active"]:
                 continue
 
-        # Default kind: server
-        if "kind" not in asset:
-            asset["kind"] = "server"
-
         # Set activated tariff
-        asset["activated_tariff"] = []
-        for asset_tariff in activated_tariff(asset["tariffs"], at_datetime, logger)["tariffs"]:
+        asset_list.append(Asset(asset, get_asset_activated_tariff(asset, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime)))
+
+    return asset_list
+
+# Yield assets one by one, activated tariff of asset is resolved only if it is accessed
+def iter_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, only_active=True):
+
+    for asset in client_raw_asset_list(client_dict):
 
-            # If tariff has file key - load it
-            if "file" in asset_tariff:
+        # Skip not active assets if only_active
+        if only_active:
+            if not asset["active"]:
+                continue
+
+        yield Asset(asset, tariff_args=(WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime))
+
+# Client YAMLs loaded once per process and indexed by lowercased name
+class ClientRegistry:
 
-                tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                if tariff_dict is None:
+    # Pass client_dicts (client_file -> client_dict) to use already loaded clients, e.g. from config snapshot
+    # Pass client_deps (client_file -> dependencies) along with client_dicts if they are known
+    # Pass index_file to keep client name index between runs, so lookups by name parse only the needed client
+    def __init__(self, WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, client_dicts=None, client_deps=None, index_file=None):
+        self.WORK_DIR = WORK_DIR
+        self.CLIENTS_SUBDIR = CLIENTS_SUBDIR
+        self.YAML_GLOB = YAML_GLOB
+        self.TARIFFS_SUBDIR = TARIFFS_SUBDIR
+        self.logger = logger
+        # client_file -> client_dict with includes resolved
+        if client_dicts is not None:
+            self.client_files = sorted(client_dicts)
+            self.client_dicts = dict(client_dicts)
+        else:
+            self.client_files = sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)))
+            self.client_dicts = {}
+        # client_file -> files and dirs relative to WORK_DIR the client config depends on
+        self.client_deps = dict(client_deps) if client_deps is not None else {}
+        # Client files selected for all clients commands, None for all
+        self.selected_client_files = None
+        # client_file -> exception caught while parsing it in worker process
+        self.client_errors = {}
+        # Lowercased client name -> client_file, built on first lookup by name
+        self.client_names = None
+        self.index_file = index_file
+        # (lowercased client name, only_active) -> (at_datetime, asset_list)
+        self.asset_lists = {}
+        # Asset fqdn -> IndexedAsset of all clients, built on first lookup by fqdn
+        self.assets_by_fqdn = None
 
-                    raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+    # Parse not yet loaded client files in parse_workers processes
+    # Results are taken in sorted file order, errors are raised later on load of the failed client file
+    def preload(self, parse_workers):
+        client_files = [client_file for client_file in self.client_files if client_file not in self.client_dicts and client_file not in self.client_errors]
+        self.logger.info("Parsing {0} client files in {1} worker processes".format(len(client_files), parse_workers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers) as executor:
+            for client_file, client_dict, include_deps, client_error in executor.map(load_client_yaml_worker, [(self.WORK_DIR, client_file, self.CLIENTS_SUBDIR, self.YAML_GLOB, self.logger) for client_file in client_files]):
+                if client_error is not None:
+                    self.client_errors[client_file] = client_error
+                else:
+                    self.client_dicts[client_file] = client_dict
+                    self.client_deps[client_file] = client_dependencies(client_file, include_deps, client_dict, self.TARIFFS_SUBDIR)
+
+    # Parse client file and record its dependencies
+    def parse(self, client_file):
+        include_deps = []
+        client_dict = load_client_yaml(self.WORK_DIR, client_file, self.CLIENTS_SUBDIR, self.YAML_GLOB, self.logger, include_deps)
+        if client_dict is None:
+            raise Exception("Config file error or missing: {0}/{1}".format(self.WORK_DIR, client_file))
+        self.client_deps[client_file] = client_dependencies(client_file, include_deps, client_dict, self.TARIFFS_SUBDIR)
+        return client_dict
 
-                asset["activated_tariff"].append(tariff_dict)
+    # Load client file, parse only on first access, parse errors are kept and raised again on next access
+    def load(self, client_file):
+        if client_file in self.client_errors:
+            raise self.client_errors[client_file]
+        if client_file not in self.client_dicts:
+            try:
+                self.client_dicts[client_file] = self.parse(client_file)
+            except Exception as e:
+                self.client_errors[client_file] = e
+                raise
+        return self.client_dicts[client_file]
 
-            # Also take inline plan and service
+    # Get client file by name, case insensitive, None if not found
+    def client_file(self, client_name):
+        if self.client_names is None:
+            if self.index_file is not None and len(self.client_dicts) < len(self.client_files):
+                self.client_names = self.load_client_index()
             else:
+                self.client_names = {}
+                for client_file in self.client_files:
+                    try:
+                        self.client_names[self.load(client_file)["name"].lower()] = client_file
+                    except Exception as e:
+                        self.logger.error("Client file {0} is not indexed: {1}".format(client_file, e))
+        client_file = self.client_names.get(client_name.lower())
+        # Client may be in a file failing to parse
+        failed_client_files = [failed_client_file for failed_client_file in self.client_files if failed_client_file in self.client_errors]
+        if client_file is None and len(failed_client_files) > 0:
+            raise LoadError("Client {0} not found in {1}/{2}, client files failed to parse: {3}".format(client_name, self.WORK_DIR, self.CLIENTS_SUBDIR, ", ".join(failed_client_files)))
+        return client_file
 
-               asset["activated_tariff"].append(asset_tariff)
+    # Get client dict by name, case insensitive
+    def get(self, client_name):
+        client_file = self.client_file(client_name)
+        if client_file is None:
+            raise LoadError("Client {0} not found in {1}/{2}".format(client_name, self.WORK_DIR, self.CLIENTS_SUBDIR))
+        return self.load(client_file)
 
-        asset_list.append(asset)
+    # Client files to iterate, only the file of client_name if it is set, nothing if there is no such client
+    # Raises LoadError if client_name is not found and some client files failed to parse
+    # Selected client files are taken if client_name is not set
+    def client_files_for(self, client_name=None):
+        if client_name is None:
+            return self.selected_client_files if self.selected_client_files is not None else self.client_files
+        client_file = self.client_file(client_name)
+        return [client_file] if client_file is not None else []
 
-    return asset_list
+    # Read client name index from index_file, reparse only clients whose file, include files, include dirs or tariff files changed
+    # Index file keeps client_file -> {"name": lowercased name, "deps": {client file, includes and tariffs: mtime}}
+    # Client files failing to parse are kept with None name and the error, they are parsed again on every run
+    # Returns lowercased client name -> client_file
+    def load_client_index(self):
+        try:
+            with open(self.index_file, "r") as f:
+                saved_index = json.load(f)
+        except Exception:
+            saved_index = {}
+        client_index = {}
+        for client_file in self.client_files:
+            index_entry = saved_index.get(client_file)
+            if index_entry is None or index_entry["name"] is None or client_deps_changed(self.WORK_DIR, index_entry["deps"]):
+                try:
+                    client_dict = self.load(client_file)
+                except Exception as e:
+                    self.logger.error("Client file {0} is not indexed: {1}".format(client_file, e))
+                    client_index[client_file] = {"name": None, "deps": {}, "error": str(e)}
+                    continue
+                index_entry = {"name": client_dict["name"].lower(), "deps": client_deps_mtimes(self.WORK_DIR, self.client_deps[client_file])}
+            else:
+                self.client_deps.setdefault(client_file, list(index_entry["deps"]))
+            client_index[client_file] = index_entry
+        if client_index != saved_index:
+            # Write to temp file and rename to make it atomic for concurrent runs
+            try:
+                os.makedirs(os.path.dirname(self.index_file), 0o755, exist_ok=True)
+                with tempfile.NamedTemporaryFile(mode="w", dir=os.path.dirname(self.index_file), suffix=".tmp", delete=False) as f:
+                    json.dump(client_index, f)
+                os.replace(f.name, self.index_file)
+                self.logger.info("Saved client index to file {0}".format(self.index_file))
+            except Exception as e:
+                self.logger.error("Saving client index to file {0} failed".format(self.index_file))
+                self.logger.exception(e)
+        return {index_entry["name"]: client_file for client_file, index_entry in client_index.items() if index_entry["name"] is not None}
+
+    # Files and dirs each client config depends on, client_file -> list relative to WORK_DIR
+    # Taken from client index if there is one, dependencies of clients failing to load are unknown and None
+    def dependencies(self):
+        if self.index_file is not None and any(client_file not in self.client_deps for client_file in self.client_files):
+            self.client_names = self.load_client_index()
+        for client_file in self.client_files:
+            if client_file not in self.client_deps:
+                try:
+                    self.load(client_file)
+                except Exception as e:
+                    self.logger.info("Client file {0} dependencies are unknown: {1}".format(client_file, e))
+                    self.client_deps[client_file] = None
+        return {client_file: self.client_deps[client_file] for client_file in self.client_files}
+
+    # Select client files for all clients commands
+    def select(self, client_files):
+        self.selected_client_files = [client_file for client_file in self.client_files if client_file in client_files]
+
+    # Get asset list of client, reused while at_datetime is the same
+    def asset_list(self, client_dict, at_datetime, only_active=True):
+        asset_list_key = (client_dict["name"].lower(), only_active)
+        if asset_list_key not in self.asset_lists or self.asset_lists[asset_list_key][0] != at_datetime:
+            self.asset_lists[asset_list_key] = (at_datetime, get_asset_list(client_dict, self.WORK_DIR, self.TARIFFS_SUBDIR, self.logger, at_datetime, only_active))
+        return self.asset_lists[asset_list_key][1]
+
+    # Assets of client one by one, already built asset list is reused
+    def iter_assets(self, client_dict, at_datetime, only_active=True):
+        asset_list_key = (client_dict["name"].lower(), only_active)
+        if asset_list_key in self.asset_lists and self.asset_lists[asset_list_key][0] == at_datetime:
+            return iter(self.asset_lists[asset_list_key][1])
+        return iter_assets(client_dict, self.WORK_DIR, self.TARIFFS_SUBDIR, self.logger, at_datetime, only_active)
+
+    # Index of assets and salt masters of all clients by fqdn, built once
+    # Active assets are preferred, not active ones are indexed only if there is no active asset with the same fqdn
+    # Duplicate active fqdns are reported once and resolved to the first occurrence
+    # Clients failing to load or to list assets and assets without fqdn are not indexed, their errors are raised where they are used
+    def asset_index(self):
+        if self.assets_by_fqdn is None:
+            assets_by_fqdn = {}
+            duplicate_fqdns = set()
+            for client_file in self.client_files:
+                try:
+                    client_dict = self.load(client_file)
+                    client_assets = client_raw_asset_list(client_dict)
+                except Exception as e:
+                    self.logger.info("Client file {0} is not indexed: {1}".format(client_file, e))
+                    continue
+                for asset in client_assets:
+                    if not isinstance(asset, dict) or "fqdn" not in asset:
+                        self.logger.info("Asset without fqdn in client file {0} is not indexed".format(client_file))
+                        continue
+                    # Active asset replaces not active one with the same fqdn, e.g. migrated to other client
+                    indexed_asset = assets_by_fqdn.get(asset["fqdn"])
+                    if indexed_asset is not None and (indexed_asset.asset.get("active") or not asset.get("active")):
+                        # Report duplicate active assets once, the first one is kept
+                        if indexed_asset.asset.get("active") and asset.get("active") and asset["fqdn"] not in duplicate_fqdns:
+                            self.logger.error("Duplicate active asset fqdn {0} found in clients {1} and {2}, using the first one".format(asset["fqdn"], indexed_asset.client_dict["name"], client_dict["name"]))
+                            duplicate_fqdns.add(asset["fqdn"])
+                        continue
+                    assets_by_fqdn[asset["fqdn"]] = IndexedAsset(client_dict, asset)
+            self.assets_by_fqdn = assets_by_fqdn
+        return self.assets_by_fqdn
+
+    # Get IndexedAsset by fqdn, None if no such asset
+    def find_asset(self, fqdn):
+        return self.asset_index().get(fqdn)
+
+# Asset with the client it belongs to, its tariff timeline is built on first use as not active assets may have no tariffs
+class IndexedAsset:
+
+    def __init__(self, client_dict, asset):
+        self.client_dict = client_dict
+        self.asset = asset
+
+    @property
+    def timeline(self):
+        return tariff_timeline(self.asset["tariffs"])
+
+# Load client YAML in worker process, return errors instead of raising to attribute them to the client file
+def load_client_yaml_worker(worker_args):
+    WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger = worker_args
+    try:
+        include_deps = []
+        client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger, include_deps)
+        if client_dict is None:
+            raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+        return client_file, client_dict, include_deps, None
+    except Exception as e:
+        return client_file, None, None, LoadError("Loading client file {0}/{1} failed: {2}".format(WORK_DIR, client_file, e))
+
+# Python types of schema node types, bool is excluded from int and number
+schema_types = {
+    "dict": (dict,),
+    "list": (list,),
+    "str": (str,),
+    "int": (int,),
+    "number": (int, float),
+    "bool": (bool,),
+    "date": (date,),
+    "scalar": (str, int, float)
+}
+
+# Join YAML path of parent and dict key or list index
+def schema_path(path, key):
+    if isinstance(key, int):
+        return "{0}[{1}]".format(path, key)
+    return "{0}.{1}".format(path, key) if path else str(key)
+
+# Compile declarative schema node into validator closure validate(value, path, context, errors)
+# Node keys:
+#   type: one of schema_types, any type if not set
+#   keys: {key: node} of dict, node required is True or name of context flag making the key required
+#   values: node for each value of dict with arbitrary keys
+#   items: node for each list item
+#   allowed: list of allowed values or name of context list
+#   only: name of context flag, node is not checked if it is not set
+#   context: function(value, context) returning context updates for the node and its children
+#   check: function(value, context) returning error text or None
+# Errors are appended as {"path", "asset", "error"}, asset is taken from context
+def compile_schema(schema):
+
+    steps = []
+
+    def error(errors, path, context, text):
+        errors.append({"path": path, "asset": context.get("asset"), "error": text})
+
+    if "context" in schema:
+        context_func = schema["context"]
+    else:
+        context_func = None
+
+    if "allowed" in schema:
+        allowed = schema["allowed"]
+        def check_allowed(value, path, context, errors):
+            allowed_values = context.get(allowed, []) if isinstance(allowed, str) else allowed
+            if value not in allowed_values:
+                error(errors, path, context, "value {0} not in allowed list {1}".format(value, allowed_values))
+        steps.append(check_allowed)
+
+    if "check" in schema:
+        check_func = schema["check"]
+        def check_custom(value, path, context, errors):
+            text = check_func(value, context)
+            if text is not None:
+                error(errors, path, context, text)
+        steps.append(check_custom)
+
+    if "keys" in schema:
+        key_validators = [(key, compile_schema(node), node.get("required", False)) for key, node in schema["keys"].items()]
+        def check_keys(value, path, context, errors):
+            for key, key_validator, required in key_validators:
+                if key in value:
+                    key_validator(value[key], schema_path(path, key), context, errors)
+                elif required is True or (required and context.get(required)):
+                    error(errors, schema_path(path, key), context, "key missing")
+        steps.append(check_keys)
+
+    if "values" in schema:
+        value_validator = compile_schema(schema["values"])
+        def check_values(value, path, context, errors):
+            for key, item in value.items():
+                value_validator(item, schema_path(path, key), context, errors)
+        steps.append(check_values)
+
+    if "items" in schema:
+        item_validator = compile_schema(schema["items"])
+        def check_items(value, path, context, errors):
+            for index, item in enumerate(value):
+                item_validator(item, schema_path(path, index), context, errors)
+        steps.append(check_items)
+
+    expected_types = schema_types[schema["type"]] if "type" in schema else None
+    bool_allowed = schema.get("type") in [None, "bool"]
+    only = schema.get("only")
+
+    def validate(value, path, context, errors):
+        if only is not None and not context.get(only):
+            return
+        if expected_types is not None and (not isinstance(value, expected_types) or (isinstance(value, bool) and not bool_allowed)):
+            error(errors, path, context, "{0} value expected, got {1}".format(schema["type"], type(value).__name__))
+            return
+        if context_func is not None:
+            context = dict(context, **context_func(value, context))
+        for step in steps:
+            step(value, path, context, errors)
+
+    return validate
+
+# Job schedule list item is a number or range like 1-5
+def job_time_item_error(value, context):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return None
+    if isinstance(value, str) and re.fullmatch(r"[0-9]+-[0-9]+", value):
+        return None
+    return "number or range like 1-5 expected, got {0}".format(value)
+
+JOB_TIME_LIST_SCHEMA = {"type": "list", "items": {"check": job_time_item_error}}
+
+JOB_SCHEMA = {
+    "type": "dict",
+    "context": lambda job, context: {
+        "job_cmd": job.get("type") == "salt_cmd",
+        "job_timeout": job.get("type") in ["salt_cmd", "rsnapshot_backup_salt"]
+    },
+    "keys": {
+        "type": {"type": "str", "required": True, "allowed": ["salt_cmd", "rsnapshot_backup_ssh", "rsnapshot_backup_salt"]},
+        "cmd": {"type": "str", "required": "job_cmd"},
+        "timeout": {"type": "scalar", "required": "job_timeout"},
+        "tz": {"type": "str", "required": True},
+        "disabled": {"type": "bool"},
+        "each": {"type": "dict", "keys": {unit: {"type": "int"} for unit in ["years", "months", "weeks", "days", "hours", "minutes"]}},
+        "minutes": JOB_TIME_LIST_SCHEMA,
+        "hours": JOB_TIME_LIST_SCHEMA,
+        "days": JOB_TIME_LIST_SCHEMA,
+        "months": JOB_TIME_LIST_SCHEMA,
+        "years": JOB_TIME_LIST_SCHEMA,
+        "weekdays": {"type": "list", "items": {"type": "str", "allowed": ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]}},
+        "licenses": {"type": "list", "items": {"type": "str"}},
+        "os": {"type": "dict", "keys": {
+            "include": {"type": "list", "items": {"type": "str", "allowed": "os"}},
+            "exclude": {"type": "list", "items": {"type": "str", "allowed": "os"}}
+        }}
+    }
+}
+
+JOBS_SCHEMA = {"type": "dict", "values": JOB_SCHEMA}
+
+TARIFF_RATE_SCHEMA = {"type": "dict", "keys": {
+    "rate": {"type": "number", "required": True},
+    "currency": {"type": "str", "required": True}
+}}
+
+# Tariff file, also inline tariff of asset
+TARIFF_SCHEMA = {
+    "type": "dict",
+    "keys": {
+        "service": {"type": "str", "required": True},
+        "plan": {"type": "str", "required": True},
+        "revision": {"type": "scalar"},
+        "monthly": TARIFF_RATE_SCHEMA,
+        "hourly": TARIFF_RATE_SCHEMA,
+        "storage": TARIFF_RATE_SCHEMA,
+        "licenses": {"type": "list", "items": {"type": "str"}}
+    }
+}
+
+# Asset tariffs list item, tariffs are either files or inline tariffs
+ASSET_TARIFF_SCHEMA = {
+    "type": "dict",
+    "keys": {
+        "activated": {"type": "date", "required": True},
+        "added": {"type": "date"},
+        "tariffs": {"type": "list", "required": True, "items": {
+            "type": "dict",
+            "context": lambda tariff, context: {"inline_tariff": "file" not in tariff},
+            "keys": dict(TARIFF_SCHEMA["keys"], **{
+                "file": {"type": "str"},
+                "service": {"type": "str", "required": "inline_tariff"},
+                "plan": {"type": "str", "required": "inline_tariff"}
+            })
+        }}
+    }
+}
+
+# Asset, also salt master, location and os are needed only for assets with pipelines
+ASSET_SCHEMA = {
+    "type": "dict",
+    "context": lambda asset, context: {
+        "asset": asset.get("fqdn") if isinstance(asset.get("fqdn"), str) else None,
+        "asset_active": bool(asset.get("active")),
+        "asset_pipelines": context.get("client_pipelines") and bool(asset.get("active")) and not asset.get("jobs_disabled", False)
+    },
+    "keys": {
+        "fqdn": {"type": "str", "required": True},
+        "active": {"type": "bool", "required": True},
+        "kind": {"type": "str"},
+        "location": {"type": "str", "required": "asset_pipelines"},
+        "os": {"type": "scalar", "required": "asset_pipelines", "only": "asset_pipelines", "allowed": "os"},
+        "jobs_disabled": {"type": "bool"},
+        "tariffs": {"type": "list", "required": "asset_active", "items": ASSET_TARIFF_SCHEMA},
+        "jobs": JOBS_SCHEMA
+    }
+}
+
+# Invoice papers need email settings if any paper is sent by email
+def billing_papers_error(papers, context):
+    if "email" in papers:
+        return None
+    if any(isinstance(papers.get(paper), dict) and papers[paper].get("email") for paper in ["act", "invoice"]):
+        return "email key missing while act or invoice is sent by email"
+    return None
+
+BILLING_PAPER_SCHEMA = {"type": "dict", "keys": {
+    "email": {"type": "bool", "required": True},
+    "print": {"type": "bool", "required": True}
+}}
+
+BILLING_PAPERS_SCHEMA = {
+    "type": "dict",
+    "check": billing_papers_error,
+    "keys": {
+        "act": BILLING_PAPER_SCHEMA,
+        "invoice": BILLING_PAPER_SCHEMA,
+        "email": {"type": "dict", "keys": {
+            "to": {"type": "str", "required": True},
+            "cc": {"type": "str"},
+            "bcc": {"type": "str"},
+            "pack_to_archive": {"type": "bool"}
+        }},
+        "envelope_address": {"type": "str"},
+        "envelope_address_no_recipient": {"type": "str"},
+        "month_shift": {"type": "scalar"},
+        "monthly_act_last_date_of_month": {"type": "bool"}
+    }
+}
+
+SALT_PROJECT_SCHEMA = {
+    "type": "dict",
+    "keys": {
+        "path": {"type": "str", "required": True},
+        "deploy_keys": {"type": "list", "items": {"type": "dict", "keys": {
+            "title": {"type": "str", "required": True},
+            "key": {"type": "str", "required": True}
+        }}},
+        "runners": {"type": "dict", "keys": {
+            "dev": {"type": "str"},
+            "prod": {"type": "str"}
+        }},
+        "variables": {"type": "dict", "values": {"type": "scalar"}}
+    }
+}
+
+# Client after includes are merged, gsuite, gitlab and assets are checked only for active clients
+CLIENT_SCHEMA = {
+    "type": "dict",
+    "context": lambda client, context: {
+        "client_active": bool(client.get("active")),
+        "client_pipelines": isinstance(client.get("gitlab"), dict) and "salt_project" in client["gitlab"] and not client.get("jobs_disabled", False),
+        "salt_masters": isinstance(client.get("configuration_management"), dict) and client["configuration_management"].get("type") == "salt"
+    },
+    "keys": {
+        "name": {"type": "str", "required": True},
+        "active": {"type": "bool", "required": True},
+        "start_date": {"required": True},
+        "jobs_disabled": {"type": "bool"},
+        "billing": {"type": "dict", "required": True, "keys": {
+            "code": {"type": "scalar", "required": True},
+            "papers": BILLING_PAPERS_SCHEMA
+        }},
+        "gsuite": {"type": "dict", "required": "client_active", "keys": {
+            "folder": {"type": "scalar", "required": "client_active"}
+        }},
+        "gitlab": {"type": "dict", "required": "client_active", "keys": {
+            "admin_project": {"type": "dict", "required": "client_active", "keys": {
+                "path": {"type": "str", "required": True}
+            }},
+            "salt_project": SALT_PROJECT_SCHEMA
+        }},
+        "configuration_management": {"type": "dict", "required": "client_active", "only": "client_active", "keys": {
+            "type": {"type": "str", "required": True},
+            "salt": {"type": "dict", "required": "salt_masters", "keys": {
+                "masters": {"type": "list", "required": "salt_masters", "items": ASSET_SCHEMA}
+            }}
+        }},
+        "servers": {"type": "list", "only": "client_active", "items": ASSET_SCHEMA},
+        "assets": {"type": "list", "only": "client_active", "items": ASSET_SCHEMA},
+        "jobs": JOBS_SCHEMA
+    }
+}
+
+# Asset fields read by jobs, tariffs are resolved only for jobs with licenses and fail only these jobs
+ASSET_JOBS_SCHEMA = dict(ASSET_SCHEMA, keys={key: ASSET_SCHEMA["keys"][key] for key in ["fqdn", "active", "kind", "location", "os", "jobs_disabled", "jobs"]})
+
+# Client fields read by jobs, problems in billing, gsuite and other fields do not skip jobs of the client
+JOBS_CLIENT_SCHEMA = dict(CLIENT_SCHEMA, keys={
+    "name": CLIENT_SCHEMA["keys"]["name"],
+    "active": CLIENT_SCHEMA["keys"]["active"],
+    "jobs_disabled": CLIENT_SCHEMA["keys"]["jobs_disabled"],
+    "gitlab": {"type": "dict", "required": "client_active", "keys": {
+        "salt_project": {"type": "dict", "keys": {
+            "path": {"type": "str", "required": True}
+        }}
+    }},
+    "configuration_management": {"type": "dict", "required": "client_active", "only": "client_active", "keys": {
+        "type": {"type": "str", "required": True},
+        "salt": {"type": "dict", "required": "salt_masters", "keys": {
+            "masters": {"type": "list", "required": "salt_masters", "items": ASSET_JOBS_SCHEMA}
+        }}
+    }},
+    "servers": {"type": "list", "only": "client_active", "items": ASSET_JOBS_SCHEMA},
+    "assets": {"type": "list", "only": "client_active", "items": ASSET_JOBS_SCHEMA},
+    "jobs": JOBS_SCHEMA
+})
+
+# Validators are compiled once per process
+client_validator = compile_schema(CLIENT_SCHEMA)
+jobs_client_validator = compile_schema(JOBS_CLIENT_SCHEMA)
+tariff_validator = compile_schema(TARIFF_SCHEMA)
+jobs_validator = compile_schema(JOBS_SCHEMA)
+
+# Validate client dict in one pass, returns list of {"path", "asset", "error"}
+# Pass jobs_client_validator as validator to check only fields read by jobs
+def validate_client_dict(client_dict, allowed_os, validator=client_validator):
+    errors = []
+    validator(client_dict, "", {"os": allowed_os}, errors)
+    return errors
+
+# Validate tariff dict, returns list of {"path", "asset", "error"}
+def validate_tariff_dict(tariff_dict):
+    errors = []
+    tariff_validator(tariff_dict, "", {}, errors)
+    return errors
+
+# Validate global jobs of accounting yaml, returns list of {"path", "asset", "error"}
+def validate_acc_yaml_jobs(acc_yaml_dict):
+    errors = []
+    if "jobs" in acc_yaml_dict:
+        jobs_validator(acc_yaml_dict["jobs"], "jobs", {"os": acc_yaml_dict.get("os", [])}, errors)
+    return errors
+
+# Validate selected clients and global jobs before any network work
+# Returns dict client_file -> list of errors for invalid clients, errors are logged
+# Client files failing to load are invalid too, other clients are still validated
+def validate_clients_before_run(client_registry, client_files, acc_yaml_dict, logger, validator=client_validator):
+    acc_yaml_errors = validate_acc_yaml_jobs(acc_yaml_dict)
+    for acc_yaml_error in acc_yaml_errors:
+        logger.error("accounting.yaml {path}: {error}".format(path=acc_yaml_error["path"], error=acc_yaml_error["error"]))
+    if len(acc_yaml_errors) > 0:
+        raise Exception("Global jobs validation found {0} errors".format(len(acc_yaml_errors)))
+    invalid_clients = {}
+    for client_file in client_files:
+        try:
+            client_dict = client_registry.load(client_file)
+        except Exception as e:
+            logger.error("{file}: {error}".format(file=client_file, error=e))
+            invalid_clients[client_file] = [{"path": "", "asset": None, "error": str(e)}]
+            continue
+        client_errors = validate_client_dict(client_dict, acc_yaml_dict.get("os", []), validator)
+        for client_error in client_errors:
+            logger.error("{file}{asset} {path}: {error}".format(file=client_file, asset=" asset " + client_error["asset"] if client_error["asset"] is not None else "", path=client_error["path"], error=client_error["error"]))
+        if len(client_errors) > 0:
+            invalid_clients[client_file] = client_errors
+    return invalid_clients
+
+# Seconds of each interval units, month is counted as 31 days
+JOB_EACH_SECONDS = {"years": 60*60*24*365, "months": 60*60*24*31, "weeks": 60*60*24*7, "days": 60*60*24, "hours": 60*60, "minutes": 60}
+JOB_WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+# Expand job schedule list of numbers and ranges like 1-5 into bitmask, single numbers are expanded to width values
+def job_time_mask(items, width=1):
+    mask = 0
+    for item in items:
+        if len(str(item).split("-")) > 1:
+            start, end = [int(bound) for bound in str(item).split("-")]
+        else:
+            start, end = int(item), int(item) + width - 1
+        for value in range(start, end + 1):
+            mask |= 1 << value
+    return mask
+
+# Job time conditions compiled once, not set conditions are None
+# Each minute of minutes is expanded by minutes_jitter as jobs are run once in minutes_jitter minutes
+class CompiledSchedule:
+
+    __slots__ = ("tz", "each_seconds", "minutes", "hours", "days", "months", "years", "weekdays", "schedule_hash")
+
+    def __init__(self, job, minutes_jitter):
+        # Hash of time conditions to find out if saved next due times are still valid
+        self.schedule_hash = json_hash([minutes_jitter] + [job.get(key) for key in ["tz", "each", "minutes", "hours", "days", "months", "years", "weekdays"]])
+        self.tz = pytz.timezone(job["tz"])
+        if "each" in job:
+            # Jitter of the previous and this run is subtracted not to skip a run because of it
+            self.each_seconds = sum(JOB_EACH_SECONDS[unit] * job["each"][unit] for unit in JOB_EACH_SECONDS if unit in job["each"]) - 2*minutes_jitter*60
+        else:
+            self.each_seconds = None
+        self.minutes = job_time_mask(job["minutes"], minutes_jitter) if "minutes" in job else None
+        self.hours = job_time_mask(job["hours"]) if "hours" in job else None
+        self.days = job_time_mask(job["days"]) if "days" in job else None
+        self.months = job_time_mask(job["months"]) if "months" in job else None
+        self.years = job_time_mask(job["years"]) if "years" in job else None
+        self.weekdays = sum(1 << JOB_WEEKDAYS.index(weekday) for weekday in job["weekdays"] if weekday in JOB_WEEKDAYS) if "weekdays" in job else None
+
+    # Return reason why job is not due at now in job tz after last run, None if it is due
+    def not_due_reason(self, now, last_run):
+        if self.each_seconds is not None and (now - last_run).total_seconds() < self.each_seconds:
+            return "{0} seconds since last run < {1}".format((now - last_run).total_seconds(), self.each_seconds)
+        if self.minutes is not None and not (self.minutes >> now.minute) & 1:
+            return "now minute {0} is not in run minutes".format(now.minute)
+        if self.hours is not None and not (self.hours >> now.hour) & 1:
+            return "now hour {0} is not in run hours".format(now.hour)
+        if self.days is not None and not (self.days >> now.day) & 1:
+            return "now day {0} is not in run days".format(now.day)
+        if self.months is not None and not (self.months >> now.month) & 1:
+            return "now month {0} is not in run months".format(now.month)
+        if self.years is not None and not (self.years >> now.year) & 1:
+            return "now year {0} is not in run years".format(now.year)
+        if self.weekdays is not None and not (self.weekdays >> now.weekday()) & 1:
+            return "now weekday {0} is not in run weekdays".format(JOB_WEEKDAYS[now.weekday()])
+        return None
+
+    # Return earliest date time not before now when job is due after last run, None if there is no such time within max_days
+    # Calendar conditions are checked on job tz local time skipping whole years, months, days and hours which don't match
+    def next_due(self, now, last_run, max_days=366*5):
+        earliest = now
+        if self.each_seconds is not None:
+            earliest = max(now, last_run + timedelta(seconds=self.each_seconds))
+        candidate = earliest.astimezone(self.tz).replace(tzinfo=None, second=0, microsecond=0)
+        limit = candidate + timedelta(days=max_days)
+        while candidate < limit:
+            if self.years is not None and not (self.years >> candidate.year) & 1:
+                if self.years >> candidate.year == 0:
+                    return None
+                candidate = datetime(candidate.year + 1, 1, 1)
+            elif self.months is not None and not (self.months >> candidate.month) & 1:
+                candidate = datetime(candidate.year + candidate.month // 12, candidate.month % 12 + 1, 1)
+            elif (self.days is not None and not (self.days >> candidate.day) & 1) or (self.weekdays is not None and not (self.weekdays >> candidate.weekday()) & 1):
+                candidate = datetime(candidate.year, candidate.month, candidate.day) + timedelta(days=1)
+            elif self.hours is not None and not (self.hours >> candidate.hour) & 1:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif self.minutes is not None and not (self.minutes >> candidate.minute) & 1:
+                candidate += timedelta(minutes=1)
+            else:
+                # Local time can be ambiguous or missing on DST change, the earliest variant is taken not to skip a run
+                return max(earliest, min(self.tz.localize(candidate, is_dst=True), self.tz.localize(candidate, is_dst=False)))
+        return None
+
+# Compiled schedules per process: id of job dict -> (job dict, schedule)
+compiled_schedules = {}
+
+# Get compiled schedule of job, GLOBAL and CLIENT jobs are the same dicts for all assets and compiled once
+def compiled_schedule(job, minutes_jitter):
+    cached = compiled_schedules.get(id(job))
+    if cached is None or cached[0] is not job:
+        cached = (job, CompiledSchedule(job, minutes_jitter))
+        compiled_schedules[id(job)] = cached
+    return cached[1]
+
+# Checked tariff files per process: tariff file relative to TARIFFS_SUBDIR -> list of errors
+yaml_checked_tariffs = {}
+
+# Load and check tariff file referenced by client for YAML check once per process, returns list of {"file", "path", "asset", "error"}
+def yaml_check_tariff_file(WORK_DIR, TARIFFS_SUBDIR, tariff_name, logger):
+    if tariff_name not in yaml_checked_tariffs:
+        tariff_file = "{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, tariff_name)
+        try:
+            tariff_dict = load_yaml(tariff_file, logger)
+            if tariff_dict is None:
+                raise Exception("Tariff file error or missing: {0}".format(tariff_file))
+            tariff_errors = validate_tariff_dict(tariff_dict)
+        except Exception as e:
+            tariff_errors = [{"path": "", "asset": None, "error": str(e)}]
+        for tariff_error in tariff_errors:
+            tariff_error["file"] = "{0}/{1}".format(TARIFFS_SUBDIR, tariff_name)
+        yaml_checked_tariffs[tariff_name] = tariff_errors
+    return yaml_checked_tariffs[tariff_name]
+
+# Check client YAML in worker process, all errors are collected instead of raising the first one
+# Structure is checked by client schema, tariff history and tariff files are checked for active assets after it
+# Returns client_file and list of {"file", "path", "asset", "error"}
+def yaml_check_client_worker(worker_args):
+    WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, allowed_os, at_datetime, logger = worker_args
+    errors = []
+
+    def error(path, asset, text):
+        errors.append({"file": client_file, "path": path, "asset": asset, "error": text})
+
+    try:
+        client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+        if client_dict is None:
+            raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+    except Exception as e:
+        error("", None, "Loading client file failed: {0}".format(e))
+        return client_file, errors
+
+    schema_errors = validate_client_dict(client_dict, allowed_os)
+    for schema_error in schema_errors:
+        error(schema_error["path"], schema_error["asset"], schema_error["error"])
+
+    # Tariffs of active assets are checked only if asset structure is valid
+    if len(schema_errors) > 0 or not client_dict["active"]:
+        return client_file, errors
+
+    for asset in client_raw_asset_list(client_dict):
+
+        if not asset["active"]:
+            continue
+
+        try:
+            tariff_timeline(asset["tariffs"]).lookup(at_datetime)
+        except Exception as e:
+            error("", asset["fqdn"], "Find active tariff error: {0}".format(e))
+
+        # Only tariff files referenced by active assets are checked, once per process, their own errors are reported for the tariff file
+        for asset_t in asset["tariffs"]:
+            for asset_tariff in asset_t["tariffs"]:
+                if "file" in asset_tariff:
+                    tariff_errors = yaml_check_tariff_file(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"], logger)
+                    if len(tariff_errors) > 0:
+                        error("", asset["fqdn"], "Tariff file error or missing: {0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]))
+                        errors.extend(tariff_errors)
+
+    return client_file, errors
+
+# Parsed include files per process: absolute path -> ((mtime, size), dict)
+include_cache = {}
+
+# Load included client YAML once per process, name is used in error message
+# Returned dict is shared between clients and must not be changed, merge_included_yaml_dicts copies what it takes
+def load_include_yaml(include_file, include_name, logger):
+    include_path = os.path.abspath(include_file)
+    try:
+        include_stat = os.stat(include_path)
+    except:
+        raise LoadError("Reading YAML from file {0} failed".format(include_name))
+    include_key = (include_stat.st_mtime_ns, include_stat.st_size)
+    if include_path in include_cache and include_cache[include_path][0] == include_key:
+        logger.info("Loading YAML from cache for file {0}".format(include_path))
+        return include_cache[include_path][1]
+    try:
+        with open(include_path, 'r') as included_yaml_file:
+            included_yaml_dict = yaml.load(included_yaml_file, Loader=YAMLSafeLoader)
+    except:
+        raise LoadError("Reading YAML from file {0} failed".format(include_name))
+    include_cache[include_path] = (include_key, included_yaml_dict)
+    return included_yaml_dict
+
+# Files and dirs relative to WORK_DIR client config depends on: client file, its includes and tariff files of its assets
+# Client dict is not validated yet, missing or malformed keys are skipped not to fail loading of the client
+def client_dependencies(client_file, include_deps, client_dict, TARIFFS_SUBDIR):
+    raw_assets = []
+    for key in ["servers", "assets"]:
+        if isinstance(client_dict.get(key), list):
+            raw_assets.extend(client_dict[key])
+    configuration_management = client_dict.get("configuration_management")
+    if isinstance(configuration_management, dict) and configuration_management.get("type") == "salt" and isinstance(configuration_management.get("salt"), dict) and isinstance(configuration_management["salt"].get("masters"), list):
+        raw_assets.extend(configuration_management["salt"]["masters"])
+    tariff_files = set()
+    for asset in raw_assets:
+        if not isinstance(asset, dict) or not isinstance(asset.get("tariffs"), list):
+            continue
+        for asset_tariffs_entry in asset["tariffs"]:
+            if not isinstance(asset_tariffs_entry, dict) or not isinstance(asset_tariffs_entry.get("tariffs"), list):
+                continue
+            for asset_tariff in asset_tariffs_entry["tariffs"]:
+                if isinstance(asset_tariff, dict) and isinstance(asset_tariff.get("file"), str):
+                    tariff_files.add("{0}/{1}".format(TARIFFS_SUBDIR, asset_tariff["file"]))
+    return [client_file] + include_deps + sorted(tariff_files)
+
+# Modification times of client file and its includes relative to WORK_DIR, None for missing ones
+def client_deps_mtimes(WORK_DIR, deps):
+    deps_mtimes = {}
+    for dep in deps:
+        try:
+            deps_mtimes[dep] = os.stat("{0}/{1}".format(WORK_DIR, dep)).st_mtime_ns
+        except OSError:
+            deps_mtimes[dep] = None
+    return deps_mtimes
+
+# Check if client file or any of its includes changed since deps_mtimes were taken
+def client_deps_changed(WORK_DIR, deps_mtimes):
+    return client_deps_mtimes(WORK_DIR, deps_mtimes.keys()) != deps_mtimes
 
 # Load asset YAML
-def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger):
+# Include files and dirs read are appended to include_deps if it is given
+def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger, include_deps=None):
     logger.info("Loading asset YAML from file {0}/{1}".format(WORK_DIR, f))
     try:
         with open("{0}/{1}".format(WORK_DIR, f), 'r') as yaml_file:
-            yaml_dict = yaml.load(yaml_file, Loader=yaml.SafeLoader)
+            yaml_dict = yaml.load(yaml_file, Loader=YAMLSafeLoader)
     except:
         raise LoadError("Reading YAML from file {0}/{1} failed".format(WORK_DIR, f))
     
     # Asset YAMLs have could have includes
     if "include" in yaml_dict:
 
+        # Assets or servers (deprecated) lists are concatenated in include order, other keys are merged
+        # Lists are collected by appending once and included dicts are merged in one pass per include kind
+        servers = list(yaml_dict["servers"]) if "servers" in yaml_dict else []
+        assets = list(yaml_dict["assets"]) if "assets" in yaml_dict else []
+        included_any = False
+
         # Include dirs
         if "dirs" in yaml_dict["include"]:
 
+            # Skip skip_files in found dir, they match as substrings of include file path
+            if "skip_files" in yaml_dict["include"] and len(yaml_dict["include"]["skip_files"]) > 0:
+                skip_files_re = re.compile("|".join(re.escape(skip_file) for skip_file in yaml_dict["include"]["skip_files"]))
+            else:
+                skip_files_re = None
+
+            included_yaml_dicts = []
             for dir_name in yaml_dict["include"]["dirs"]:
 
+                if include_deps is not None:
+                    include_deps.append("{0}/{1}".format(CLIENTS_SUBDIR, dir_name))
+
                 # Include dir_name/*.yaml
                 for include_file in sorted(glob.glob("{0}/{1}/{2}/{3}".format(WORK_DIR, CLIENTS_SUBDIR, dir_name, YAML_GLOB))):
 
                     logger.info("Found include file: {0}".format(include_file))
 
-                    # Skip skip_files in found dir
-                    should_open = True
-                    if "skip_files" in yaml_dict["include"]:
-                        for skip_file in yaml_dict["include"]["skip_files"]:
-                            if skip_file in include_file:
-                                should_open = False
-                    if should_open:
-                        try:
-                            with open(include_file, 'r') as included_yaml_file:
-                                included_yaml_dict = yaml.load(included_yaml_file, Loader=yaml.SafeLoader)
-                        except:
-                            raise LoadError("Reading YAML from file {0} failed".format(include_file))
-                    else:
+                    if skip_files_re is not None and skip_files_re.search(include_file):
                         continue
 
-                    # Save previous assets or servers (deprecated) list before merging dicts
-                    if "servers" in yaml_dict:
-                        old_servers = yaml_dict["servers"]
-                    else:
-                        old_servers = []
-                    if "assets" in yaml_dict:
-                        old_assets = yaml_dict["assets"]
-                    else:
-                        old_assets = []
-
-                    # Save new assets or servers (deprecated) list before merging dicts
-                    if "servers" in included_yaml_dict:
-                        new_servers = included_yaml_dict["servers"]
-                    else:
-                        new_servers = []
-                    if "assets" in included_yaml_dict:
-                        new_assets = included_yaml_dict["assets"]
-                    else:
-                        new_assets = []
-
-                    # Merge dicts, assets will be replaced by included from file
-                    merge(yaml_dict, included_yaml_dict)
-
-                    # Set assets or servers from old and new
-                    yaml_dict["servers"] = old_servers + new_servers
-                    yaml_dict["assets"] = old_assets + new_assets
+                    included_yaml_dicts.append(load_include_yaml(include_file, include_file, logger))
+                    if include_deps is not None:
+                        include_deps.append(os.path.relpath(include_file, WORK_DIR))
+
+            # Merge dicts, data in later files supersedes data in earlier
+            servers, assets = merge_included_yaml_dicts(yaml_dict, included_yaml_dicts, servers, assets)
+            included_any = included_any or len(included_yaml_dicts) > 0
 
         # Include files, data in files supersedes data in dirs
         if "files" in yaml_dict["include"]:
 
-                # Include dir_name/*.yaml
-                for include_file in yaml_dict["include"]["files"]:
+            included_yaml_dicts = []
+            for include_file in yaml_dict["include"]["files"]:
+                included_yaml_dicts.append(load_include_yaml("{0}/{1}".format(CLIENTS_SUBDIR, include_file), include_file, logger))
+                if include_deps is not None:
+                    include_deps.append("{0}/{1}".format(CLIENTS_SUBDIR, include_file))
 
-                    try:
-                        with open("{0}/{1}".format(CLIENTS_SUBDIR, include_file), 'r') as included_yaml_file:
-                            included_yaml_dict = yaml.load(included_yaml_file, Loader=yaml.SafeLoader)
-                    except:
-                        raise LoadError("Reading YAML from file {0} failed".format(include_file))
-
-                    # Save previous assets or servers (deprecated) list before merging dicts
-                    if "servers" in yaml_dict:
-                        old_servers = yaml_dict["servers"]
-                    else:
-                        old_servers = []
-                    if "assets" in yaml_dict:
-                        old_assets = yaml_dict["assets"]
-                    else:
-                        old_assets = []
-
-                    # Save new assets or servers (deprecated) list before merging dicts
-                    if "servers" in included_yaml_dict:
-                        new_servers = included_yaml_dict["servers"]
-                    else:
-                        new_servers = []
-                    if "assets" in included_yaml_dict:
-                        new_assets = included_yaml_dict["assets"]
-                    else:
-                        new_assets = []
-
-                    # Merge dicts, assets will be replaced by included from file
-                    merge(yaml_dict, included_yaml_dict)
-
-                    # Set assets or servers from old and new
-                    yaml_dict["servers"] = old_servers + new_servers
-                    yaml_dict["assets"] = old_assets + new_assets
+            servers, assets = merge_included_yaml_dicts(yaml_dict, included_yaml_dicts, servers, assets)
+            included_any = included_any or len(included_yaml_dicts) > 0
+
+        # Set assets or servers from old and new
+        if included_any:
+            yaml_dict["servers"] = servers
+            yaml_dict["assets"] = assets
 
     return yaml_dict
+
+# Merge included dicts into yaml_dict except assets and servers (deprecated), which are appended to given lists
+# Included dicts are shared via include cache, so assets are deep copied and merge deep copies the rest itself
+def merge_included_yaml_dicts(yaml_dict, included_yaml_dicts, servers, assets):
+    merge_sources = []
+    for included_yaml_dict in included_yaml_dicts:
+        if "servers" in included_yaml_dict:
+            servers.extend(copy.deepcopy(included_yaml_dict["servers"]))
+        if "assets" in included_yaml_dict:
+            assets.extend(copy.deepcopy(included_yaml_dict["assets"]))
+        merge_sources.append({key: value for key, value in included_yaml_dict.items() if key not in ["servers", "assets"]})
+    merge(yaml_dict, *merge_sources)
+    return servers, assets
+
+# All files resolved configuration depends on, relative to WORK_DIR
+def config_input_files(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, TARIFFS_SUBDIR):
+    input_files = [ACC_YAML]
+    for subdir in [CLIENTS_SUBDIR, TARIFFS_SUBDIR]:
+        for input_file in sorted(glob.glob("{0}/{1}/**/*.yaml".format(WORK_DIR, subdir), recursive=True)):
+            input_files.append(os.path.relpath(input_file, WORK_DIR))
+    return input_files
+
+# Content hashes of configuration input files, input file -> sha256
+def config_file_hashes(WORK_DIR, input_files):
+    file_hashes = {}
+    for input_file in input_files:
+        with open("{0}/{1}".format(WORK_DIR, input_file), "rb") as f:
+            file_hashes[input_file] = hashlib.sha256(f.read()).hexdigest()
+    return file_hashes
+
+# Content hash of all configuration input files
+def config_hash(file_hashes):
+    config_sha = hashlib.sha256()
+    for input_file in sorted(file_hashes):
+        config_sha.update(input_file.encode("utf-8") + b"\0" + file_hashes[input_file].encode("utf-8") + b"\0")
+    return config_sha.hexdigest()
+
+# Save input file hashes and client dependencies of snapshot to snapshot_dir/<hash>.manifest.json to find clients affected since it
+# Manifests are small and kept after their snapshots are removed, only keep_manifests newest of them are kept
+def save_config_manifest(snapshot_dir, snapshot_hash, file_hashes, client_deps, logger, keep_manifests=100):
+    manifest_file = "{0}/{1}.manifest.json".format(snapshot_dir, snapshot_hash)
+    with tempfile.NamedTemporaryFile(mode="w", dir=snapshot_dir, suffix=".tmp", delete=False) as f:
+        json.dump({"files": file_hashes, "deps": client_deps}, f)
+    os.replace(f.name, manifest_file)
+    logger.info("Saved config manifest to file {0}".format(manifest_file))
+    manifest_files = sorted(glob.glob("{0}/*.manifest.json".format(snapshot_dir)), key=os.path.getmtime, reverse=True)
+    for old_manifest_file in manifest_files[keep_manifests:]:
+        os.remove(old_manifest_file)
+
+# Client files affected by config changes since snapshot since_hash
+# Client is affected if its client file, includes or tariff files changed, by its dependencies now or in that snapshot
+# All clients are affected if accounting yaml changed
+def affected_client_files(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, TARIFFS_SUBDIR, SNAPSHOT_SUBDIR, since_hash, client_registry, logger):
+    manifest_file = "{0}/{1}/{2}.manifest.json".format(WORK_DIR, SNAPSHOT_SUBDIR, since_hash)
+    try:
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+    except Exception:
+        raise LoadError("Config manifest for snapshot {0} not found in {1}/{2}".format(since_hash, WORK_DIR, SNAPSHOT_SUBDIR))
+    file_hashes = config_file_hashes(WORK_DIR, config_input_files(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, TARIFFS_SUBDIR))
+    changed_files = set(input_file for input_file in set(file_hashes) | set(manifest["files"]) if file_hashes.get(input_file) != manifest["files"].get(input_file))
+    logger.info("Config files changed since snapshot {0}: {1}".format(since_hash, sorted(changed_files)))
+    if ACC_YAML in changed_files:
+        return list(client_registry.client_files)
+    client_deps = client_registry.dependencies()
+    affected_files = []
+    for client_file in client_registry.client_files:
+        if client_depends_on(changed_files, client_deps[client_file]) or client_depends_on(changed_files, manifest["deps"].get(client_file, [])):
+            affected_files.append(client_file)
+    logger.info("Clients affected since snapshot {0}: {1}".format(since_hash, affected_files))
+    return affected_files
+
+# Check if any of changed files is among client dependencies, directly or as a file in included dir
+# Unknown dependencies (None) depend on any change
+def client_depends_on(changed_files, deps):
+    if deps is None:
+        return len(changed_files) > 0
+    for changed_file in changed_files:
+        if changed_file in deps or os.path.dirname(changed_file) in deps:
+            return True
+    return False
+
+# Files relative to WORK_DIR changed in work tree against git ref REF, including untracked ones
+# Returns None if git cannot tell, callers should check everything then
+def git_changed_files(WORK_DIR, ref, logger):
+    try:
+        diff_result = subprocess.run(["git", "-C", WORK_DIR, "diff", "--name-only", "--relative", ref, "--"], universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        untracked_result = subprocess.run(["git", "-C", WORK_DIR, "ls-files", "--others", "--exclude-standard"], universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    except Exception as e:
+        logger.error("Getting changed files against git ref {0} failed, checking all: {1}".format(ref, e))
+        return None
+    return set(line for line in (diff_result.stdout + untracked_result.stdout).split("\n") if line != "")
+
+# Client files affected by changes in work tree against git ref REF, None if git cannot tell
+# All clients are affected if accounting yaml changed
+def affected_client_files_since_ref(WORK_DIR, ACC_YAML, ref, client_registry, logger):
+    changed_files = git_changed_files(WORK_DIR, ref, logger)
+    if changed_files is None:
+        return None
+    logger.info("Files changed against git ref {0}: {1}".format(ref, sorted(changed_files)))
+    if ACC_YAML in changed_files:
+        return list(client_registry.client_files)
+    client_deps = client_registry.dependencies()
+    affected_files = [client_file for client_file in client_registry.client_files if client_depends_on(changed_files, client_deps[client_file])]
+    logger.info("Clients affected against git ref {0}: {1}".format(ref, affected_files))
+    return affected_files
+
+# Make YAML values JSON compatible, dates become strings
+def json_compatible(value):
+    return json.loads(json.dumps(value, default=str))
+
+# Hash of YAML value to compare it between configuration states
+def json_hash(value):
+    return hashlib.sha256(json.dumps(value, default=str, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Resolved configuration state of all clients to diff what changed for downstream syncs, JSON compatible
+# Lowercased client name -> {"active", "settings" hash, "envelope", "assets": fqdn -> {"tariffs", "ssh", "other" hash}}
+# Not active clients and assets may have no tariffs, their tariffs are empty then
+def config_state(client_registry, at_datetime):
+    state = {}
+    for client_file in client_registry.client_files:
+        client_dict = client_registry.load(client_file)
+        client_assets = {}
+        for asset in client_registry.iter_assets(client_dict, at_datetime, False):
+            # Activated tariff is resolved only for assets with tariffs, inline tariffs may have no revision
+            client_assets[asset["fqdn"]] = {
+                "tariffs": ["{0} {1} {2}".format(tar.service, tar.plan, tar.revision) for tar in asset.activated_tariff] if "tariffs" in asset else [],
+                "ssh": json_compatible({key: asset[key] for key in ["ssh", "roster_opts"] if key in asset}),
+                "other": json_hash({key: asset[key] for key in asset if key not in ["ssh", "roster_opts", "tariffs", "activated_tariff"]})
+            }
+        billing = client_dict.get("billing", {})
+        state[client_dict["name"].lower()] = {
+            "active": client_dict.get("active"),
+            "settings": json_hash({key: value for key, value in client_dict.items() if key not in ["servers", "assets"]}),
+            "envelope": json_compatible({
+                "merchant": billing.get("merchant"),
+                "template": billing.get("template"),
+                "papers": {key: value for key, value in billing.get("papers", {}).items() if key.startswith("envelope_")}
+            }),
+            "assets": client_assets
+        }
+    return state
+
+# Changes between two configuration states, list of {"client", "change", "asset", "old", "new"}
+# Change is one of client_added, client_removed, client_changed, envelope_changed, asset_added, asset_removed, asset_changed, tariff_changed, ssh_changed
+def config_changes(old_state, new_state):
+    changes = []
+    for client in sorted(set(old_state) | set(new_state)):
+        if client not in old_state:
+            changes.append({"client": client, "change": "client_added", "asset": None, "old": None, "new": None})
+            continue
+        if client not in new_state:
+            changes.append({"client": client, "change": "client_removed", "asset": None, "old": None, "new": None})
+            continue
+        old_client, new_client = old_state[client], new_state[client]
+        if old_client["active"] != new_client["active"] or old_client["settings"] != new_client["settings"]:
+            changes.append({"client": client, "change": "client_changed", "asset": None, "old": None, "new": None})
+        if old_client["envelope"] != new_client["envelope"]:
+            changes.append({"client": client, "change": "envelope_changed", "asset": None, "old": old_client["envelope"], "new": new_client["envelope"]})
+        for asset in sorted(set(old_client["assets"]) | set(new_client["assets"])):
+            if asset not in old_client["assets"]:
+                changes.append({"client": client, "change": "asset_added", "asset": asset, "old": None, "new": None})
+                continue
+            if asset not in new_client["assets"]:
+                changes.append({"client": client, "change": "asset_removed", "asset": asset, "old": None, "new": None})
+                continue
+            old_asset, new_asset = old_client["assets"][asset], new_client["assets"][asset]
+            if old_asset["tariffs"] != new_asset["tariffs"]:
+                changes.append({"client": client, "change": "tariff_changed", "asset": asset, "old": old_asset["tariffs"], "new": new_asset["tariffs"]})
+            if old_asset["ssh"] != new_asset["ssh"]:
+                changes.append({"client": client, "change": "ssh_changed", "asset": asset, "old": old_asset["ssh"], "new": new_asset["ssh"]})
+            if old_asset["other"] != new_asset["other"]:
+                changes.append({"client": client, "change": "asset_changed", "asset": asset, "old": None, "new": None})
+    return changes
+
+# Parse accounting yaml, all clients with includes and all tariffs into one dict
+# Clients are parsed into client_registry, so parsed clients can be reused if some client fails to parse
+def build_config_snapshot(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, parse_workers=None, client_registry=None):
+    acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+    if acc_yaml_dict is None:
+        raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+    if client_registry is None:
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger)
+    if parse_workers is not None:
+        client_registry.preload(parse_workers)
+    # Parse all clients before raising the first error
+    client_dicts = {}
+    client_error = None
+    for client_file in client_registry.client_files:
+        try:
+            client_dicts[client_file] = client_registry.load(client_file)
+        except Exception as e:
+            if client_error is None:
+                client_error = e
+    if client_error is not None:
+        raise client_error
+    client_deps = client_registry.dependencies()
+    tariff_dicts = {}
+    for tariff_file in sorted(glob.glob("{0}/{1}/**/*.yaml".format(WORK_DIR, TARIFFS_SUBDIR), recursive=True)):
+        tariff_dicts[tariff_file] = load_yaml(tariff_file, logger)
+    return {"acc_yaml": acc_yaml_dict, "clients": client_dicts, "deps": client_deps, "tariffs": tariff_dicts}
+
+# Load compiled configuration snapshot from SNAPSHOT_SUBDIR/<hash>.pickle, rebuild it if any input file changed
+# Returns None if snapshot cannot be built, callers should fall back to client_registry then, clients parsed by the failed build stay loaded in it
+# Failed build is marked with SNAPSHOT_SUBDIR/<hash>.failed and not retried until some input file changes
+def load_config_snapshot(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, SNAPSHOT_SUBDIR, logger, parse_workers=None, client_registry=None):
+    file_hashes = config_file_hashes(WORK_DIR, config_input_files(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, TARIFFS_SUBDIR))
+    snapshot_hash = config_hash(file_hashes)
+    snapshot_dir = "{0}/{1}".format(WORK_DIR, SNAPSHOT_SUBDIR)
+    snapshot_file = "{0}/{1}.pickle".format(snapshot_dir, snapshot_hash)
+    failed_file = "{0}/{1}.failed".format(snapshot_dir, snapshot_hash)
+    if os.path.isfile(snapshot_file):
+        logger.info("Loading config snapshot from file {0}".format(snapshot_file))
+        try:
+            with open(snapshot_file, "rb") as f:
+                snapshot = pickle.load(f)
+            seed_tariff_cache(snapshot["tariffs"])
+            return snapshot
+        except Exception as e:
+            logger.error("Loading config snapshot from file {0} failed, rebuilding".format(snapshot_file))
+            logger.exception(e)
+    if os.path.isfile(failed_file):
+        logger.info("Building config snapshot {0} failed before, falling back to YAML files".format(snapshot_hash))
+        return None
+    logger.info("Building config snapshot {0}".format(snapshot_hash))
+    try:
+        snapshot = build_config_snapshot(WORK_DIR, ACC_YAML, CLIENTS_SUBDIR, YAML_GLOB, TARIFFS_SUBDIR, logger, parse_workers, client_registry)
+    except Exception as e:
+        logger.info("Building config snapshot failed, falling back to YAML files: {0}".format(e))
+        # Mark failed build, remove outdated marks
+        try:
+            os.makedirs(snapshot_dir, 0o755, exist_ok=True)
+            open(failed_file, "w").close()
+            for old_failed_file in glob.glob("{0}/*.failed".format(snapshot_dir)):
+                if old_failed_file != failed_file:
+                    os.remove(old_failed_file)
+        except Exception as e:
+            logger.error("Saving config snapshot failed mark to file {0} failed".format(failed_file))
+            logger.exception(e)
+        return None
+    snapshot["hash"] = snapshot_hash
+    # Write to temp file and rename to make it atomic for concurrent runs, remove outdated snapshots
+    try:
+        os.makedirs(snapshot_dir, 0o755, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=snapshot_dir, suffix=".tmp", delete=False) as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, snapshot_file)
+        for old_snapshot_file in glob.glob("{0}/*.pickle".format(snapshot_dir)) + glob.glob("{0}/*.failed".format(snapshot_dir)):
+            if old_snapshot_file != snapshot_file:
+                os.remove(old_snapshot_file)
+        logger.info("Saved config snapshot to file {0}".format(snapshot_file))
+        save_config_manifest(snapshot_dir, snapshot_hash, file_hashes, snapshot["deps"], logger)
+    except Exception as e:
+        logger.error("Saving config snapshot to file {0} failed".format(snapshot_file))
+        logger.exception(e)
+    seed_tariff_cache(snapshot["tariffs"])
+    return snapshot